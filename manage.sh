@@ -22,6 +22,7 @@ BOT_FILE="$SCRIPT_DIR/tele_agent.py"
 BOT_LOG="$SCRIPT_DIR/bot_agent.log"
 DB_PATH="$SCRIPT_DIR/data/chat_history.db"
 PID_FILE="$SCRIPT_DIR/.bot.pid"
+WORKER_PATTERN="tele_agent.py --worker "
 
 # Configuration
 OLLAMA_PORT=11434
@@ -76,6 +77,7 @@ check_bot() {
         BOT_PID=$(cat "$PID_FILE")
         if kill -0 "$BOT_PID" 2>/dev/null; then
             print_success "Bot is running (PID: $BOT_PID)"
+            check_workers
             return 0
         else
             rm -f "$PID_FILE"
@@ -84,7 +86,7 @@ check_bot() {
         fi
     else
         if is_process_running "tele_agent.py"; then
-            PID=$(pgrep -f "tele_agent.py" | head -1)
+            PID=$(pgrep -of "tele_agent.py")  # Oldest: the front, not a worker
             echo "$PID" > "$PID_FILE"
             print_success "Bot is running (PID: $PID)"
             return 0
@@ -95,6 +97,15 @@ check_bot() {
     fi
 }
 
+check_workers() {
+    # Shard workers are children of the front process (BOT_WORKERS > 1)
+    local pids
+    pids=$(pgrep -f "$WORKER_PATTERN" | tr '\n' ' ')
+    if [ -n "$pids" ]; then
+        print_info "Shard workers: $(echo $pids | wc -w) (PIDs: $pids)"
+    fi
+}
+
 check_port_available() {
     local port=$1
     if lsof -Pi :$port -sTCP:LISTEN -t >/dev/null 2>&1; then
@@ -147,6 +158,7 @@ start_ollama() {
 }
 
 start_bot() {
+    local workers=${1:-}
     print_header "Starting Telegram Bot"
     
     if check_bot; then
@@ -179,7 +191,13 @@ start_bot() {
     # Start bot in background
     print_warning "Starting bot in background..."
     source "$VENV_PATH/bin/activate"
-    nohup python3 "$BOT_FILE" >> "$BOT_LOG" 2>&1 &
+    if [ -n "$workers" ]; then
+        # Front process + N shard workers (it restarts workers that exit)
+        print_info "Sharded mode: $workers workers"
+        nohup python3 "$BOT_FILE" --workers "$workers" >> "$BOT_LOG" 2>&1 &
+    else
+        nohup python3 "$BOT_FILE" >> "$BOT_LOG" 2>&1 &
+    fi
     BOT_PID=$!
     echo "$BOT_PID" > "$PID_FILE"
     
@@ -196,6 +214,43 @@ start_bot() {
     fi
 }
 
+autotune_bot() {
+    print_header "Auto-tuning Ollama Options"
+    
+    if [ ! -d "$VENV_PATH" ]; then
+        print_error "Virtual environment not found at $VENV_PATH"
+        print_info "Run: sudo ./setup_system.sh"
+        return 1
+    fi
+    
+    if ! check_ollama; then
+        print_warning "Ollama is not running, starting it..."
+        if ! start_ollama; then
+            return 1
+        fi
+    fi
+    
+    print_warning "Benchmarking num_thread / num_batch / num_ctx (takes a few minutes)..."
+    source "$VENV_PATH/bin/activate"
+    (cd "$SCRIPT_DIR" && python3 "$BOT_FILE" --autotune)
+    
+    print_success "Profile saved to data/tuning_profiles.json (restart bot to apply)"
+}
+
+loadtest_bot() {
+    local workers=${1:-4}
+    print_header "Load Test (1..$workers shard workers)"
+    
+    if [ ! -d "$VENV_PATH" ]; then
+        print_error "Virtual environment not found at $VENV_PATH"
+        print_info "Run: sudo ./setup_system.sh"
+        return 1
+    fi
+    
+    source "$VENV_PATH/bin/activate"
+    (cd "$SCRIPT_DIR" && python3 "$BOT_FILE" --loadtest "$workers")
+}
+
 ##############################################################################
 # Stop Functions
 ##############################################################################
@@ -236,8 +291,11 @@ stop_bot() {
         print_warning "Stopping bot (PID: $BOT_PID)..."
         kill "$BOT_PID" 2>/dev/null || true
         
-        # Wait for graceful shutdown
-        sleep 2
+        # Wait for graceful shutdown (front waits up to 10s for its workers)
+        for i in {1..12}; do
+            kill -0 "$BOT_PID" 2>/dev/null || break
+            sleep 1
+        done
         
         # Force kill if still running
         if kill -0 "$BOT_PID" 2>/dev/null; then
@@ -246,6 +304,14 @@ stop_bot() {
         fi
     fi
     
+    # Shard workers left behind by a killed front process
+    if pgrep -f "$WORKER_PATTERN" > /dev/null 2>&1; then
+        print_warning "Stopping leftover shard workers..."
+        pkill -f "$WORKER_PATTERN" || true
+        sleep 2
+        pkill -9 -f "$WORKER_PATTERN" || true
+    fi
+    
     rm -f "$PID_FILE"
     print_success "Bot stopped"
 }
@@ -339,7 +405,7 @@ restart_all() {
 restart_bot() {
     stop_bot
     sleep 1
-    start_bot
+    start_bot "$1"
 }
 
 restart_ollama() {
@@ -405,9 +471,16 @@ db_cleanup() {
     sqlite3 "$DB_PATH" "
     DELETE FROM conversations 
     WHERE datetime(timestamp) < datetime('now', '-30 days');
-    VACUUM;
     "
     
+    # The delete trigger only records tombstones in the search index;
+    # merging segments purges them so the index shrinks with the table
+    if [ -n "$(sqlite3 "$DB_PATH" "SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts';")" ]; then
+        sqlite3 "$DB_PATH" "INSERT INTO conversations_fts (conversations_fts, rank) VALUES ('merge', 500);"
+    fi
+    
+    sqlite3 "$DB_PATH" "VACUUM;"
+    
     print_success "Cleanup completed"
 }
 
@@ -562,7 +635,7 @@ show_help() {
 CORE COMMANDS:
 ──────────────
   status              Show system status
-  start               Start all services (Ollama + Bot)
+  start [N]           Start all services (Ollama + Bot, N shard workers)
   stop                Stop all services
   restart             Restart all services
 
@@ -572,9 +645,11 @@ SERVICE COMMANDS:
   stop-ollama         Stop Ollama only
   restart-ollama      Restart Ollama
 
-  start-bot           Start Bot only
-  stop-bot            Stop Bot only
-  restart-bot         Restart Bot only
+  start-bot [N]       Start Bot only (N > 1: front process + N workers)
+  stop-bot            Stop Bot and its shard workers
+  restart-bot [N]     Restart Bot only
+  autotune            Benchmark & save best Ollama options for this host
+  loadtest [N]        Measure throughput with 1..N shard workers
 
 LOG COMMANDS:
 ─────────────
@@ -617,6 +692,7 @@ EXAMPLES:
   ./manage.sh db-backup           # Backup database
   ./manage.sh monitor             # Monitor system resources
   ./manage.sh restart-bot         # Restart bot only
+  ./manage.sh start-bot 4         # Front process + 4 shard workers
   ./manage.sh db-cleanup          # Clean old messages
 
 TIPS:
@@ -685,7 +761,7 @@ main() {
         
         # Core services
         start)
-            start_ollama && start_bot
+            start_ollama && start_bot "$2"
             ;;
         stop)
             stop_bot && stop_ollama
@@ -707,13 +783,19 @@ main() {
         
         # Bot
         start-bot)
-            start_bot
+            start_bot "$2"
             ;;
         stop-bot)
             stop_bot
             ;;
         restart-bot)
-            restart_bot
+            restart_bot "$2"
+            ;;
+        autotune)
+            autotune_bot
+            ;;
+        loadtest)
+            loadtest_bot "$2"
             ;;
         
         # Logs
@@ -66,12 +66,21 @@ else
     print_success "System already set up"
 fi
 
-# Step 3: Start services
-print_header "Step 3: Starting Services"
+# Step 3: Calibrate Ollama options for this host (once per host/model)
+print_header "Step 3: Auto-tuning"
+
+if [ ! -f "$SCRIPT_DIR/data/tuning_profiles.json" ]; then
+    bash "$SCRIPT_DIR/manage.sh" autotune || print_warning "Auto-tune failed, using default options"
+else
+    print_success "Tuning profile already exists (re-run: ./manage.sh autotune)"
+fi
+
+# Step 4: Start services
+print_header "Step 4: Starting Services"
 
 bash "$SCRIPT_DIR/manage.sh" start
 
-# Step 4: Show next steps
+# Step 5: Show next steps
 print_header "Installation Completed! 🎉"
 
 echo -e "${GREEN}All services started successfully!${NC}\n"
@@ -155,6 +155,12 @@ pull_model() {
     
     sleep 3
     
+    # Embedding model for uploaded documents (also needed by existing installs)
+    if ! ollama list 2>/dev/null | grep -q "nomic-embed-text"; then
+        print_warning "Pulling nomic-embed-text embedding model (~270MB)..."
+        ollama pull nomic-embed-text
+    fi
+    
     # Check if model already exists
     if ollama list 2>/dev/null | grep -q "qwen2.5:7b"; then
         print_success "Model qwen2.5:7b already exists"
@@ -10,4 +10,5 @@ if [ ! -f "$MANAGE_SCRIPT" ]; then
 fi
 
 chmod +x "$MANAGE_SCRIPT"
-"$MANAGE_SCRIPT" start
+# Optional argument: number of shard workers (./start.sh 4)
+"$MANAGE_SCRIPT" start "$@"
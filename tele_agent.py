@@ -5,28 +5,40 @@
 # Kết nối Telegram Bot với Ollama AI Engine
 ##############################################################################
 
+from __future__ import annotations
+
 import os
 import sys
 import json
 import gc
+import time
 import sqlite3
 import asyncio
+import random
+import math
 import logging
+import operator
+import threading
+import hashlib
+import bisect
+import signal
+from array import array
+from collections import deque, Counter
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Tuple, TYPE_CHECKING
 from pathlib import Path
 from functools import wraps
-import psutil
 
-# Load environment variables from .env file
-from dotenv import load_dotenv
-load_dotenv()
+# Third-party imports are deferred (telegram, ollama, psutil, dotenv) so the
+# module imports fast and polling can start before the heavy stack is loaded.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
-# Third-party imports
-from telegram import Update, Chat
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
-from telegram.error import TelegramError
-import ollama
+# Process start reference for time-to-ready / time-to-first-reply metrics
+PROCESS_START = time.monotonic()
 
 # ChatAction constants (compatible with all python-telegram-bot versions)
 CHAT_ACTION_TYPING = 'typing'
@@ -43,6 +55,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+##############################################################################
+# Lazy Singletons
+##############################################################################
+
+class LazyInstance:
+    """
+    Proxy that builds the wrapped object on first attribute access
+    Keeps module import cheap: config, database and agent are created
+    only when the first handler (or main) touches them
+    """
+    
+    def __init__(self, factory: Callable[[], Any]):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+    
+    def _get(self) -> Any:
+        instance = object.__getattribute__(self, '_instance')
+        if instance is None:
+            instance = object.__getattribute__(self, '_factory')()
+            object.__setattr__(self, '_instance', instance)
+        return instance
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
+    
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._get(), name, value)
+
 ##############################################################################
 # Configuration
 ##############################################################################
@@ -50,28 +90,144 @@ logger = logging.getLogger(__name__)
 class Config:
     """Configuration management"""
     
-    # Telegram
-    TELEGRAM_API_TOKEN = os.getenv('TELEGRAM_API_TOKEN', '')
-    ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', 0))
-    
     # Ollama
-    OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
-    OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'qwen2.5:7b')
     OLLAMA_THREADS = 8  # Tăng threads cho CPU 12 cores
     
     # System
     MAX_WORKERS = 1  # Chỉ xử lý 1 request AI tại một lúc
     QUEUE_CHECK_INTERVAL = 2  # Seconds
     HISTORY_LIMIT = 20  # Max messages in history
+    SEARCH_PAGE_SIZE = 5  # /search results per page
+    SEARCH_CANDIDATES = 2000  # Newest matches ranked per query
+    SEARCH_BACKFILL_BATCH = 5000  # Message ids indexed per transaction when building the index
+    
+    # Document retrieval (uploaded .txt files)
+    OLLAMA_EMBED_MODEL = 'nomic-embed-text'
+    DOC_MAX_CHARS = 500000  # Indexed characters per upload
+    DOC_CHUNK_CHARS = 800
+    DOC_CHUNK_OVERLAP = 100
+    DOC_TOP_K = 4
+    DOC_MIN_SCORE = 0.35  # Cosine similarity below this is ignored
+    DOC_CTX_FRACTION = 0.25  # Share of num_ctx spent on retrieved chunks
+    DOC_EMBED_BATCH = 16  # Chunks per embedding request
+    DOC_INDEX_MAX_SECONDS = 600  # Hard cap on indexing one upload
+    CHARS_PER_TOKEN = 3  # Rough estimate for Vietnamese text
     DATABASE_PATH = './data/chat_history.db'
     TEMP_FILES_PATH = './data/temp_files'
     
     # Memory management (8GB RAM optimized)
     MAX_MESSAGE_LENGTH = 4000
-    GC_INTERVAL = 5  # Run garbage collection every 5 responses
-    MEMORY_THRESHOLD_MB = 1000  # Alert if free memory < 1GB
+    MEMORY_THRESHOLD_MB = 1000  # Governor steps in when available memory < 2x this
+    OLLAMA_NUM_CTX = 4096
+    REDUCED_NUM_CTX = 2048  # Context window under memory pressure
+    REDUCED_HISTORY_LIMIT = 8  # History messages under memory pressure
+    BOT_RSS_LIMIT_MB = 600  # Bot RSS that triggers cache dropping
+    GOVERNOR_INTERVAL = 15  # Seconds between memory checks
+    MODEL_IDLE_SECONDS = 120  # Unused this long, a model may be unloaded under critical pressure
+    GC_THRESHOLDS = (50000, 50, 100)  # Fewer gen0/gen2 passes than (700, 10, 10)
+    
+    # Host auto-tuning (python3 tele_agent.py --autotune or /autotune)
+    OLLAMA_NUM_BATCH = 512
+    TUNING_PROFILES_PATH = './data/tuning_profiles.json'
+    AUTOTUNE_CTX_CANDIDATES = (2048, 4096)
+    AUTOTUNE_BATCH_CANDIDATES = (256, 512)
+    AUTOTUNE_PREDICT = 64  # Tokens generated per benchmark run
+    AUTOTUNE_TOLERANCE = 0.10  # Prefer larger num_ctx within 10% of best score
+    
+    # Per-chat quotas (admin is exempt)
+    QUOTA_MESSAGES_PER_MINUTE = 6
+    QUOTA_TOKENS_PER_DAY = 50000  # Counted from Ollama eval_count
+    QUOTA_MAX_QUEUED = 2  # Jobs waiting or running per chat
+    QUOTA_FLUSH_INTERVAL = 60  # Seconds between usage persistence
+    
+    # Coalesce rapid consecutive messages from the same chat
+    COALESCE_WINDOW = 1.5  # Seconds of silence before a batch is sent
+    COALESCE_MAX_WAIT = 5.0  # Upper bound on debounce delay
+    
+    # Per-route inference caps (hard max duration, generated tokens)
+    ROUTE_LIMITS = {
+        'chat': {'max_seconds': 180, 'num_predict': 1024},
+        'file': {'max_seconds': 300, 'num_predict': 2048},
+    }
+    SUPERSEDE_RUNNING = True  # New message cancels the chat's running inference
+    
+    # Tracing (OTLP/JSON lines) & profiling
+    TRACE_ENABLED = True
+    TRACE_SAMPLE_RATE = 1.0  # Fraction of updates traced
+    TRACE_FILE = './data/traces.jsonl'
+    TRACE_FILE_MAX_MB = 50  # Rotate to .1 when larger
+    TRACE_FLUSH_INTERVAL = 5  # Seconds between trace file writes
+    TRACE_BUFFER_MAX = 1000  # Unwritten traces kept (oldest dropped)
+    TRACE_KEEP = 200  # Recent traces kept in memory for /traces
+    TRACE_SLOW_SECONDS = 20  # Log breakdown of traces slower than this
+    PROFILE_INTERVAL = 0.01  # Sampling profiler interval (seconds)
+    PROFILE_MAX_SECONDS = 300
+    
+    # Sharded deployment (front process + N workers owning chat_id shards)
+    BOT_WORKERS = 1  # >1 runs the front/worker deployment
+    BROKER_PATH = './data/broker.db'
+    BROKER_POLL_INTERVAL = 0.05  # Seconds between empty broker polls
+    BROKER_BATCH = 32  # Updates claimed per poll
+    WORKER_RESTART_DELAY = 5  # Seconds before a dead worker is restarted
+    WORKER_INDEX: Optional[int] = None  # Set in worker processes
+    
+    # Startup
+    WARMUP_ENABLED = True  # Preload model in background after polling starts
+    WARMUP_KEEP_ALIVE = '30m'  # Keep model resident after warm-up
     
     def __init__(self):
+        # Load environment variables from .env file
+        from dotenv import load_dotenv
+        load_dotenv()
+        
+        # Telegram
+        self.TELEGRAM_API_TOKEN = os.getenv('TELEGRAM_API_TOKEN', '')
+        self.ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', 0))
+        
+        # Ollama
+        self.OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+        self.OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'qwen2.5:7b')
+        self.OLLAMA_EMBED_MODEL = os.getenv('OLLAMA_EMBED_MODEL', self.OLLAMA_EMBED_MODEL)
+        # Backends for sharded workers (worker i uses OLLAMA_URLS[i % len])
+        self.OLLAMA_URLS = [
+            url.strip() for url in os.getenv('OLLAMA_URLS', self.OLLAMA_URL).split(',') if url.strip()
+        ]
+        
+        # Memory governor
+        self.MEMORY_THRESHOLD_MB = int(os.getenv('MEMORY_THRESHOLD_MB', self.MEMORY_THRESHOLD_MB))
+        self.BOT_RSS_LIMIT_MB = int(os.getenv('BOT_RSS_LIMIT_MB', self.BOT_RSS_LIMIT_MB))
+        
+        # Per-chat quotas
+        self.QUOTA_MESSAGES_PER_MINUTE = int(os.getenv('QUOTA_MESSAGES_PER_MINUTE', self.QUOTA_MESSAGES_PER_MINUTE))
+        self.QUOTA_TOKENS_PER_DAY = int(os.getenv('QUOTA_TOKENS_PER_DAY', self.QUOTA_TOKENS_PER_DAY))
+        self.QUOTA_MAX_QUEUED = int(os.getenv('QUOTA_MAX_QUEUED', self.QUOTA_MAX_QUEUED))
+        
+        # Coalescing
+        self.COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', self.COALESCE_WINDOW))
+        self.COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', self.COALESCE_MAX_WAIT))
+        
+        # Inference caps: CHAT_MAX_SECONDS, CHAT_NUM_PREDICT, FILE_MAX_SECONDS, ...
+        self.ROUTE_LIMITS = {
+            route: {
+                key: int(os.getenv(f'{route.upper()}_{key.upper()}', value))
+                for key, value in limits.items()
+            }
+            for route, limits in Config.ROUTE_LIMITS.items()
+        }
+        self.SUPERSEDE_RUNNING = os.getenv('SUPERSEDE_RUNNING', '1') != '0'
+        
+        # Tracing
+        self.TRACE_ENABLED = os.getenv('TRACE_ENABLED', '1') != '0'
+        self.TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', self.TRACE_SAMPLE_RATE))
+        self.TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', self.TRACE_SLOW_SECONDS))
+        
+        # Sharded deployment
+        self.BOT_WORKERS = int(os.getenv('BOT_WORKERS', self.BOT_WORKERS))
+        
+        # Startup
+        self.WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '1') != '0'
+        self.WARMUP_KEEP_ALIVE = os.getenv('WARMUP_KEEP_ALIVE', self.WARMUP_KEEP_ALIVE)
+        
         if not self.TELEGRAM_API_TOKEN:
             raise ValueError("TELEGRAM_API_TOKEN not set in .env file")
         if self.ADMIN_CHAT_ID == 0:
@@ -81,7 +237,259 @@ class Config:
         Path(self.TEMP_FILES_PATH).mkdir(parents=True, exist_ok=True)
         Path(Path(self.DATABASE_PATH).parent).mkdir(parents=True, exist_ok=True)
 
-config = Config()
+config = LazyInstance(Config)
+
+##############################################################################
+# Tracing & Profiling
+##############################################################################
+
+# Span active in the current task (None = not traced)
+_current_span: ContextVar[Optional[Dict[str, Any]]] = ContextVar('current_span', default=None)
+
+class Tracer:
+    """
+    Lightweight per-update tracing
+    Each Telegram update becomes one trace; spans cover auth, database,
+    queue lock wait, Ollama and Telegram sends. Finished traces are kept
+    in memory for /traces and appended to TRACE_FILE as OTLP/JSON lines
+    by a background thread (one file per shard worker).
+    """
+    
+    def __init__(self):
+        self.enabled = config.TRACE_ENABLED
+        self.sample_rate = config.TRACE_SAMPLE_RATE
+        self.file_path = config.TRACE_FILE
+        self.instance = 'main'
+        if config.WORKER_INDEX is not None:
+            # Workers never share (and rotate) the same file
+            self.instance = f'w{config.WORKER_INDEX}'
+            path = Path(config.TRACE_FILE)
+            self.file_path = str(path.with_name(f"{path.stem}.{self.instance}{path.suffix}"))
+        self.recent: deque = deque(maxlen=config.TRACE_KEEP)
+        self.pending: deque = deque(maxlen=config.TRACE_BUFFER_MAX)  # Finished, not yet written
+        self.write_lock = threading.Lock()
+    
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """Start a new trace with a root span (no-op if unsampled)"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield {}
+            return
+        
+        trace = {'trace_id': os.urandom(16).hex(), 'spans': []}
+        try:
+            with self._span(trace, None, name, attributes) as attrs:
+                yield attrs
+        finally:
+            # Failed updates are recorded too (root span carries the error)
+            self._finish(trace)
+    
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Child span of the current span (no-op outside a trace)"""
+        parent = _current_span.get()
+        if parent is None:
+            yield {}
+            return
+        
+        with self._span(parent['trace'], parent['span_id'], name, attributes) as attrs:
+            yield attrs
+    
+    @contextmanager
+    def _span(self, trace: Dict[str, Any], parent_id: Optional[str], name: str, attributes: Dict[str, Any]):
+        span = {
+            'trace': trace,
+            'span_id': os.urandom(8).hex(),
+            'parent_id': parent_id,
+            'name': name,
+            'start_ns': time.time_ns(),
+            'end_ns': None,
+            'attributes': dict(attributes),
+            'error': None,
+        }
+        trace['spans'].append(span)
+        token = _current_span.set(span)
+        try:
+            yield span['attributes']
+        except BaseException as e:
+            span['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span['end_ns'] = time.time_ns()
+            _current_span.reset(token)
+    
+    def _finish(self, trace: Dict[str, Any]) -> None:
+        """Record finished trace in memory and queue it for export"""
+        root = trace['spans'][0]
+        trace['name'] = root['name']
+        trace['duration'] = (root['end_ns'] - root['start_ns']) / 1e9
+        trace['breakdown'] = self._breakdown(trace)
+        self.recent.append(trace)
+        
+        if trace['duration'] >= config.TRACE_SLOW_SECONDS:
+            parts = ', '.join(f"{name}={sec:.2f}s" for name, sec in trace['breakdown'])
+            logger.warning(f"Slow trace {trace['trace_id']} {trace['name']} {trace['duration']:.1f}s: {parts}")
+        
+        self.pending.append(trace)
+    
+    @staticmethod
+    def _breakdown(trace: Dict[str, Any]) -> List[Tuple[str, float]]:
+        """Total seconds per span name (excluding root), slowest first"""
+        totals: Dict[str, float] = {}
+        for span in trace['spans'][1:]:
+            totals[span['name']] = totals.get(span['name'], 0.0) + (span['end_ns'] - span['start_ns']) / 1e9
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+    
+    def _otlp_line(self, trace: Dict[str, Any]) -> str:
+        """Trace as one OTLP/JSON ExportTraceServiceRequest line"""
+        spans = []
+        for span in trace['spans']:
+            otlp_span = {
+                'traceId': trace['trace_id'],
+                'spanId': span['span_id'],
+                'name': span['name'],
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': str(span['start_ns']),
+                'endTimeUnixNano': str(span['end_ns']),
+                'attributes': [
+                    {'key': key, 'value': self._otlp_value(value)}
+                    for key, value in span['attributes'].items()
+                ],
+                'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1},
+            }
+            if span['parent_id']:
+                otlp_span['parentSpanId'] = span['parent_id']
+            spans.append(otlp_span)
+        
+        return json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': 'tele_agent'}},
+                    {'key': 'service.instance.id', 'value': {'stringValue': self.instance}},
+                ]},
+                'scopeSpans': [{'scope': {'name': 'tele_agent'}, 'spans': spans}],
+            }]
+        }, ensure_ascii=False)
+    
+    def flush(self) -> None:
+        """Append pending traces to the trace file (runs in a worker thread)"""
+        with self.write_lock:
+            lines = []
+            while self.pending:
+                lines.append(self._otlp_line(self.pending.popleft()))
+            if not lines:
+                return
+            try:
+                path = Path(self.file_path)
+                if path.exists() and path.stat().st_size > config.TRACE_FILE_MAX_MB * 1024 * 1024:
+                    path.replace(path.with_name(path.name + '.1'))
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+            except Exception as e:
+                logger.error(f"Error exporting traces: {str(e)}")
+    
+    async def run_export_loop(self) -> None:
+        """Background task: write traces every TRACE_FLUSH_INTERVAL"""
+        try:
+            while True:
+                await asyncio.sleep(config.TRACE_FLUSH_INTERVAL)
+                await asyncio.to_thread(self.flush)
+        finally:
+            self.flush()
+    
+    def slowest(self, n: int) -> List[Dict[str, Any]]:
+        """Get the N slowest recent traces"""
+        return sorted(self.recent, key=lambda t: t['duration'], reverse=True)[:n]
+
+tracer = LazyInstance(Tracer)
+
+def trace_span(name: str):
+    """Decorator: wrap a sync function call in a child span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced(func):
+    """Decorator: start a trace for each Telegram update handled by func"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        with tracer.trace(f"handler.{func.__name__}", chat_id=chat_id, update_id=update.update_id):
+            return await func(update, context)
+    return wrapper
+
+class SamplingProfiler:
+    """
+    Opt-in sampling profiler for a running bot
+    Samples all thread stacks every PROFILE_INTERVAL and writes folded
+    stacks (flamegraph.pl / speedscope compatible) next to the database
+    """
+    
+    def __init__(self):
+        self.running = False
+    
+    def _sample(self, seconds: float) -> Tuple[Counter, Counter, int]:
+        own_ident = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter = Counter()
+        leaves: Counter = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                leaves[stack[0]] += 1
+                stacks[';'.join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            samples += 1
+            time.sleep(config.PROFILE_INTERVAL)
+        
+        return stacks, leaves, samples
+    
+    async def profile(self, seconds: float) -> Tuple[str, List[Tuple[str, float]]]:
+        """
+        Profile for N seconds
+        Returns: (folded stacks file path, top leaf frames with % of samples)
+        """
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+        self.running = True
+        try:
+            stacks, leaves, samples = await asyncio.to_thread(self._sample, seconds)
+        finally:
+            self.running = False
+        
+        out_path = Path(config.DATABASE_PATH).parent / f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+        with open(out_path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        
+        top = [(frame, 100.0 * count / max(samples, 1)) for frame, count in leaves.most_common(10)]
+        return str(out_path), top
+
+profiler = LazyInstance(SamplingProfiler)
 
 ##############################################################################
 # Database Management
@@ -90,13 +498,22 @@ config = Config()
 class ChatDatabase:
     """SQLite database for conversation history"""
     
+    # Chat IDs are indexed as tokens ("c123", "cn100123" for negative IDs)
+    # so a per-chat search is a posting-list intersection, not a scan
+    CHAT_TOKEN_SQL = "'c' || replace(CAST({}.chat_id AS TEXT), '-', 'n')"
+    
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.fts_enabled = False
+        self.fts_backfill_pending = False
         self._init_database()
+        self._init_search_index()
     
     def _init_database(self):
         """Initialize database schema"""
         with sqlite3.connect(self.db_path) as conn:
+            # WAL lets sharded workers read while another process writes
+            conn.execute('PRAGMA journal_mode=WAL')
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS conversations (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -128,17 +545,267 @@ class ChatDatabase:
                 )
             ''')
             
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS quotas (
+                    chat_id INTEGER PRIMARY KEY,
+                    messages_per_minute INTEGER NOT NULL,
+                    tokens_per_day INTEGER NOT NULL,
+                    max_queued INTEGER NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    file_name TEXT NOT NULL,
+                    embed_model TEXT NOT NULL,
+                    chunk_count INTEGER DEFAULT 0,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS document_chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                    chat_id INTEGER NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    embedding BLOB NOT NULL
+                )
+            ''')
+            
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_document_chunks_chat ON document_chunks(chat_id)'
+            )
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS usage_daily (
+                    chat_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    messages INTEGER DEFAULT 0,
+                    tokens INTEGER DEFAULT 0,
+                    rejected INTEGER DEFAULT 0,
+                    PRIMARY KEY (chat_id, day)
+                )
+            ''')
+            
+            conn.commit()
+    
+    def _init_search_index(self):
+        """
+        Create the FTS5 index over conversations (contentless, kept in
+        sync by triggers so inserts, /clear and retention deletes all
+        update it). Messages that existed before the index are queued in
+        search_index_backfill and indexed by run_search_index_build();
+        search stays disabled until that finishes.
+        """
+        new_token = self.CHAT_TOKEN_SQL.format('new')
+        old_token = self.CHAT_TOKEN_SQL.format('old')
+        # Rows still waiting for the backfill are not in the index yet
+        indexed = '''NOT EXISTS (
+            SELECT 1 FROM search_index_backfill WHERE old.id > next_id AND old.id <= end_id
+        )'''
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                exists = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'"
+                ).fetchone()
+                
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS search_index_backfill (
+                        next_id INTEGER NOT NULL,
+                        end_id INTEGER NOT NULL
+                    )
+                ''')
+                if not exists:
+                    end_id = conn.execute('SELECT MAX(id) FROM conversations').fetchone()[0]
+                    if end_id:
+                        conn.execute(
+                            'INSERT INTO search_index_backfill (next_id, end_id) VALUES (0, ?)', (end_id,)
+                        )
+                
+                conn.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+                        content, chat,
+                        content='',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                ''')
+                
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS conversations_fts_insert
+                    AFTER INSERT ON conversations BEGIN
+                        INSERT INTO conversations_fts (rowid, content, chat)
+                        VALUES (new.id, new.content, {new_token});
+                    END
+                ''')
+                
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS conversations_fts_delete
+                    AFTER DELETE ON conversations WHEN {indexed} BEGIN
+                        INSERT INTO conversations_fts (conversations_fts, rowid, content, chat)
+                        VALUES ('delete', old.id, old.content, {old_token});
+                    END
+                ''')
+                
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS conversations_fts_update
+                    AFTER UPDATE OF content, chat_id ON conversations WHEN {indexed} BEGIN
+                        INSERT INTO conversations_fts (conversations_fts, rowid, content, chat)
+                        VALUES ('delete', old.id, old.content, {old_token});
+                        INSERT INTO conversations_fts (rowid, content, chat)
+                        VALUES (new.id, new.content, {new_token});
+                    END
+                ''')
+                
+                pending = conn.execute('SELECT 1 FROM search_index_backfill').fetchone()
+                conn.commit()
+            self.fts_backfill_pending = pending is not None
+            self.fts_enabled = not self.fts_backfill_pending
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text search disabled (FTS5 unavailable): {str(e)}")
+    
+    def build_search_index(self) -> bool:
+        """
+        Index the next SEARCH_BACKFILL_BATCH ids of pre-existing messages
+        Each batch is its own short write transaction, so sharded workers
+        can share the work and writers are never blocked for long.
+        Returns: True when the backfill is complete
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            state = conn.execute('SELECT next_id, end_id FROM search_index_backfill').fetchone()
+            if state is None:
+                conn.execute('COMMIT')
+                return True
+            next_id, end_id = state
+            upto = min(next_id + config.SEARCH_BACKFILL_BATCH, end_id)
+            conn.execute(f'''
+                INSERT INTO conversations_fts (rowid, content, chat)
+                SELECT id, content, {self.CHAT_TOKEN_SQL.format('conversations')}
+                FROM conversations
+                WHERE id > ? AND id <= ?
+            ''', (next_id, upto))
+            if upto >= end_id:
+                conn.execute('DELETE FROM search_index_backfill')
+            else:
+                conn.execute('UPDATE search_index_backfill SET next_id = ?', (upto,))
+            conn.execute('COMMIT')
+            return upto >= end_id
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    async def run_search_index_build(self) -> None:
+        """Background task: backfill the search index, then enable /search"""
+        if not self.fts_backfill_pending:
+            return
+        logger.info("Building full-text search index over existing conversations...")
+        try:
+            while not await asyncio.to_thread(self.build_search_index):
+                await asyncio.sleep(0.05)  # Let other writers in between batches
+        except Exception as e:
+            logger.error(f"Error building search index: {str(e)}")
+            return
+        self.fts_backfill_pending = False
+        self.fts_enabled = True
+        logger.info("Built full-text search index over conversations")
+    
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """Turn free text into a safe FTS5 expression (all terms, quoted)"""
+        terms = [term.replace('"', '""') for term in query.split()]
+        return ' '.join(f'"{term}"' for term in terms if term)
+    
+    @trace_span('db.search_messages')
+    def search_messages(self, query: str, chat_id: Optional[int] = None, limit: int = 5,
+                        offset: int = 0, before_id: Optional[int] = None) -> Tuple[List[Dict], bool, Optional[int]]:
+        """
+        Full-text search over conversation history (BM25 ranked)
+        Only the newest SEARCH_CANDIDATES matches (older than before_id) are
+        ranked; when there are more, the oldest ranked id is returned so the
+        caller can continue with before_id.
+        
+        Args:
+            query: Free text, all terms must match (diacritics ignored)
+            chat_id: Restrict to one chat (None = all chats)
+            limit, offset: Pagination
+            before_id: Only match messages with a smaller id
+        
+        Returns:
+            (matching messages, whether more results exist in this window,
+             before_id for the next older window or None if complete)
+        """
+        expression = self._fts_query(query)
+        if not self.fts_enabled or not expression:
+            return [], False, None
+        
+        match = f"content : ({expression})"
+        if chat_id is not None:
+            chat_token = 'c' + str(chat_id).replace('-', 'n')
+            match = f'chat : "{chat_token}" AND {match}'
+        before_id = before_id if before_id is not None else sys.maxsize
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            # BM25-rank only the newest SEARCH_CANDIDATES matches: FTS5 walks
+            # the doclist in rowid order and stops, so common terms stay cheap.
+            # One extra candidate tells whether older matches were left out.
+            candidates = conn.execute('''
+                SELECT rowid, rank FROM conversations_fts
+                WHERE conversations_fts MATCH ? AND rowid < ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            ''', (match, before_id, config.SEARCH_CANDIDATES + 1)).fetchall()
+            
+            next_before_id = None
+            if len(candidates) > config.SEARCH_CANDIDATES:
+                candidates = candidates[:config.SEARCH_CANDIDATES]
+                next_before_id = candidates[-1][0]  # Oldest ranked match
+            
+            ranked = [row[0] for row in sorted(candidates, key=operator.itemgetter(1))]
+            page_ids = ranked[offset:offset + limit + 1]
+            placeholders = ','.join('?' * len(page_ids))
+            by_id = {
+                row['id']: dict(row)
+                for row in conn.execute(f'''
+                    SELECT id, chat_id, role, content, timestamp
+                    FROM conversations WHERE id IN ({placeholders})
+                ''', page_ids)
+            }
+            rows = [by_id[row_id] for row_id in page_ids if row_id in by_id]
+        
+        return rows[:limit], len(rows) > limit, next_before_id
+    
+    @trace_span('db.maintain_search_index')
+    def maintain_search_index(self, pages: int = 500):
+        """Incrementally merge index segments (purges deleted rows)"""
+        if not self.fts_enabled:
+            return
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO conversations_fts (conversations_fts, rank) VALUES ('merge', ?)",
+                (pages,)
+            )
             conn.commit()
     
-    def add_message(self, chat_id: int, username: str, role: str, content: str):
+    @trace_span('db.add_message')
+    def add_message(self, chat_id: int, username: str, role: str, content: str, tokens: int = 0):
         """Add message to history"""
         with sqlite3.connect(self.db_path) as conn:
             conn.execute('''
-                INSERT INTO conversations (chat_id, user, role, content)
-                VALUES (?, ?, ?, ?)
-            ''', (chat_id, username, role, content))
+                INSERT INTO conversations (chat_id, user, role, content, tokens)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, username, role, content, tokens))
             conn.commit()
     
+    @trace_span('db.get_history')
     def get_history(self, chat_id: int, limit: int = 20) -> List[Dict]:
         """Get conversation history"""
         with sqlite3.connect(self.db_path) as conn:
@@ -154,6 +821,7 @@ class ChatDatabase:
             messages = [dict(row) for row in cursor.fetchall()]
             return list(reversed(messages))
     
+    @trace_span('db.update_user_stats')
     def update_user_stats(self, chat_id: int, username: str):
         """Update user statistics"""
         with sqlite3.connect(self.db_path) as conn:
@@ -178,6 +846,7 @@ class ChatDatabase:
             
             conn.commit()
     
+    @trace_span('db.cleanup_old_messages')
     def cleanup_old_messages(self, days: int = 30):
         """Delete messages older than specified days"""
         with sqlite3.connect(self.db_path) as conn:
@@ -186,7 +855,11 @@ class ChatDatabase:
                 WHERE datetime(timestamp) < datetime('now', '-' || ? || ' days')
             ''', (days,))
             conn.commit()
+        
+        # Triggers removed the rows from the index; merge away the tombstones
+        self.maintain_search_index()
     
+    @trace_span('db.add_to_whitelist')
     def add_to_whitelist(self, chat_id: int, username: str, added_by: int) -> bool:
         """Add user to whitelist"""
         try:
@@ -201,6 +874,7 @@ class ChatDatabase:
             logger.error(f"Error adding to whitelist: {str(e)}")
             return False
     
+    @trace_span('db.remove_from_whitelist')
     def remove_from_whitelist(self, chat_id: int) -> bool:
         """Remove user from whitelist"""
         try:
@@ -212,6 +886,7 @@ class ChatDatabase:
             logger.error(f"Error removing from whitelist: {str(e)}")
             return False
     
+    @trace_span('db.is_whitelisted')
     def is_whitelisted(self, chat_id: int) -> bool:
         """Check if user is in whitelist"""
         try:
@@ -222,6 +897,7 @@ class ChatDatabase:
             logger.error(f"Error checking whitelist: {str(e)}")
             return False
     
+    @trace_span('db.get_whitelist')
     def get_whitelist(self) -> List[tuple]:
         """Get all whitelisted users"""
         try:
@@ -231,9 +907,144 @@ class ChatDatabase:
         except Exception as e:
             logger.error(f"Error getting whitelist: {str(e)}")
             return []
+    
+    @trace_span('db.add_document')
+    def add_document(self, chat_id: int, file_name: str, embed_model: str,
+                     chunks: List[Tuple[str, bytes]]) -> int:
+        """Store a document's chunks with their embeddings, returns document ID"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                INSERT INTO documents (chat_id, file_name, embed_model, chunk_count)
+                VALUES (?, ?, ?, ?)
+            ''', (chat_id, file_name, embed_model, len(chunks)))
+            document_id = cursor.lastrowid
+            conn.executemany('''
+                INSERT INTO document_chunks (document_id, chat_id, chunk_index, content, embedding)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (document_id, chat_id, index, content, embedding)
+                for index, (content, embedding) in enumerate(chunks)
+            ])
+            conn.commit()
+        return document_id
+    
+    @trace_span('db.get_document_chunks')
+    def get_document_chunks(self, chat_id: int, embed_model: str) -> List[tuple]:
+        """Get (file_name, content, embedding) of a chat's chunks for one embedding model"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                SELECT d.file_name, c.content, c.embedding
+                FROM document_chunks c
+                JOIN documents d ON d.id = c.document_id
+                WHERE c.chat_id = ? AND d.embed_model = ?
+                ORDER BY c.document_id, c.chunk_index
+            ''', (chat_id, embed_model))
+            return cursor.fetchall()
+    
+    @trace_span('db.get_documents')
+    def get_documents(self, chat_id: int) -> List[tuple]:
+        """Get (id, file_name, chunk_count, created_at) of a chat's documents"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute('''
+                    SELECT id, file_name, chunk_count, created_at FROM documents
+                    WHERE chat_id = ? ORDER BY created_at DESC
+                ''', (chat_id,))
+                return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting documents: {str(e)}")
+            return []
+    
+    @trace_span('db.delete_documents')
+    def delete_documents(self, chat_id: int) -> int:
+        """Delete all documents of a chat, returns number deleted"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('DELETE FROM document_chunks WHERE chat_id = ?', (chat_id,))
+            cursor = conn.execute('DELETE FROM documents WHERE chat_id = ?', (chat_id,))
+            conn.commit()
+            return cursor.rowcount
+    
+    @trace_span('db.get_quotas')
+    def get_quotas(self) -> Dict[int, Dict[str, int]]:
+        """Get per-chat quota overrides"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute('''
+                    SELECT chat_id, messages_per_minute, tokens_per_day, max_queued
+                    FROM quotas
+                ''')
+                return {
+                    row[0]: {
+                        'messages_per_minute': row[1],
+                        'tokens_per_day': row[2],
+                        'max_queued': row[3],
+                    }
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            logger.error(f"Error getting quotas: {str(e)}")
+            return {}
+    
+    @trace_span('db.set_quota')
+    def set_quota(self, chat_id: int, messages_per_minute: int, tokens_per_day: int, max_queued: int) -> bool:
+        """Set quota override for a chat"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO quotas (chat_id, messages_per_minute, tokens_per_day, max_queued)
+                    VALUES (?, ?, ?, ?)
+                ''', (chat_id, messages_per_minute, tokens_per_day, max_queued))
+                conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error setting quota: {str(e)}")
+            return False
+    
+    @trace_span('db.get_usage')
+    def get_usage(self, day: str) -> Dict[int, Dict[str, int]]:
+        """Get per-chat usage counters for a day (YYYY-MM-DD)"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute(
+                    'SELECT chat_id, messages, tokens, rejected FROM usage_daily WHERE day = ?',
+                    (day,)
+                )
+                return {
+                    row[0]: {'messages': row[1], 'tokens': row[2], 'rejected': row[3]}
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            logger.error(f"Error getting usage: {str(e)}")
+            return {}
+    
+    @trace_span('db.save_usage')
+    def save_usage(self, day: str, usage: Dict[int, Dict[str, int]]) -> bool:
+        """
+        Add per-chat usage deltas for a day
+        Additive so processes flushing the same rows never overwrite
+        each other's counts
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.executemany('''
+                    INSERT INTO usage_daily (chat_id, day, messages, tokens, rejected)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id, day) DO UPDATE SET
+                        messages = messages + excluded.messages,
+                        tokens = tokens + excluded.tokens,
+                        rejected = rejected + excluded.rejected
+                ''', [
+                    (chat_id, day, u['messages'], u['tokens'], u['rejected'])
+                    for chat_id, u in usage.items()
+                ])
+                conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error saving usage: {str(e)}")
+            return False
 
 # Initialize database
-db = ChatDatabase(config.DATABASE_PATH)
+db = LazyInstance(lambda: ChatDatabase(config.DATABASE_PATH))
 
 ##############################################################################
 # AI Request Queue Management
@@ -265,6 +1076,16 @@ class RequestQueue:
         self.waiting_users[chat_id] = position
         return position
 
+    @asynccontextmanager
+    async def slot(self):
+        """Hold the inference lock (lock wait is traced)"""
+        with tracer.span('queue.lock_wait'):
+            await self.lock.acquire()
+        try:
+            yield
+        finally:
+            self.lock.release()
+    
     def mark_done(self, chat_id: int) -> None:
         """Remove user from waiting list"""
         if chat_id in self.waiting_users:
@@ -297,47 +1118,430 @@ class RequestQueue:
             'waiting_users': len(self.waiting_users)
         }
 
-queue_manager = RequestQueue(max_workers=config.MAX_WORKERS)
+queue_manager = LazyInstance(lambda: RequestQueue(max_workers=config.MAX_WORKERS))
 
 ##############################################################################
-# System Monitoring
+# Per-chat Quotas
 ##############################################################################
 
-class SystemMonitor:
-    """Monitor system resources"""
+class QuotaManager:
+    """
+    Per-chat rate limiting and token quotas
+    Checked before a request reaches RequestQueue so one chat cannot
+    monopolise the single inference slot. Counters live in memory and
+    their increments are flushed to SQLite periodically. A shard worker
+    only loads and counts the chats it owns.
+    """
     
-    @staticmethod
-    def get_memory_info() -> Dict[str, Any]:
-        """Get memory usage information"""
-        vm = psutil.virtual_memory()
-        swap = psutil.swap_memory()
-        
-        return {
-            'total_gb': vm.total / (1024**3),
-            'used_gb': vm.used / (1024**3),
-            'available_gb': vm.available / (1024**3),
-            'percent': vm.percent,
-            'swap_total_gb': swap.total / (1024**3),
-            'swap_used_gb': swap.used / (1024**3),
-            'swap_percent': swap.percent,
+    def __init__(self):
+        self.defaults = {
+            'messages_per_minute': config.QUOTA_MESSAGES_PER_MINUTE,
+            'tokens_per_day': config.QUOTA_TOKENS_PER_DAY,
+            'max_queued': config.QUOTA_MAX_QUEUED,
         }
+        self.overrides: Dict[int, Dict[str, int]] = db.get_quotas()
+        self.day = self._today()
+        self.usage: Dict[int, Dict[str, int]] = self._load_usage(self.day)
+        self.flushed: Dict[int, Dict[str, int]] = {  # Counters as of the last flush
+            chat_id: dict(usage) for chat_id, usage in self.usage.items()
+        }
+        self.recent: Dict[int, deque] = {}  # chat_id -> admission timestamps (last minute)
+        self.queued: Dict[int, int] = {}  # chat_id -> jobs waiting or running
+        self.dirty = False
+        self.flush_lock = threading.RLock()  # flush() runs both in a thread and on the loop
     
     @staticmethod
-    def get_cpu_info() -> Dict[str, Any]:
-        """Get CPU usage information"""
-        return {
-            'cores': psutil.cpu_count(),
-            'percent': psutil.cpu_percent(interval=0.5),
-            'per_core': psutil.cpu_percent(interval=0.5, percpu=True),
-            'load_avg': os.getloadavg(),
-        }
+    def _today() -> str:
+        return datetime.now().strftime('%Y-%m-%d')
     
     @staticmethod
-    def get_full_status() -> str:
-        """Get full system status report"""
-        mem = SystemMonitor.get_memory_info()
-        cpu = SystemMonitor.get_cpu_info()
-        queue_status = queue_manager.get_queue_status()
+    def _load_usage(day: str) -> Dict[int, Dict[str, int]]:
+        return {chat_id: usage for chat_id, usage in db.get_usage(day).items() if shard_router.owns(chat_id)}
+    
+    def _rollover(self) -> None:
+        """Reset daily counters at midnight (persisting the previous day)"""
+        today = self._today()
+        if today != self.day:
+            with self.flush_lock:
+                self.flush()
+                self.day = today
+                self.usage = {}
+                self.flushed = {}
+    
+    def _usage(self, chat_id: int) -> Dict[str, int]:
+        if chat_id not in self.usage:
+            self.usage[chat_id] = {'messages': 0, 'tokens': 0, 'rejected': 0}
+        return self.usage[chat_id]
+    
+    def get_limits(self, chat_id: int) -> Dict[str, int]:
+        """Get effective limits for a chat"""
+        return self.overrides.get(chat_id, self.defaults)
+    
+    def reload_limits(self, chat_id: int) -> None:
+        """Re-read a chat's override (set by /quota on another worker)"""
+        override = db.get_quotas().get(chat_id)
+        if override:
+            self.overrides[chat_id] = override
+        else:
+            self.overrides.pop(chat_id, None)
+    
+    def set_limits(self, chat_id: int, messages_per_minute: int, tokens_per_day: int, max_queued: int) -> bool:
+        """Set and persist quota override for a chat"""
+        if not db.set_quota(chat_id, messages_per_minute, tokens_per_day, max_queued):
+            return False
+        self.overrides[chat_id] = {
+            'messages_per_minute': messages_per_minute,
+            'tokens_per_day': tokens_per_day,
+            'max_queued': max_queued,
+        }
+        return True
+    
+    def acquire(self, chat_id: int, job: bool = True) -> Optional[str]:
+        """
+        Admit a request for chat_id
+        job=False admits a message merged into an existing job: it counts
+        toward the rate limit but does not take a queue slot
+        Returns: None if admitted, otherwise a rejection message
+        """
+        self._rollover()
+        if chat_id == config.ADMIN_CHAT_ID:
+            if job:
+                self.queued[chat_id] = self.queued.get(chat_id, 0) + 1
+            return None
+        
+        limits = self.get_limits(chat_id)
+        usage = self._usage(chat_id)
+        now = time.monotonic()
+        
+        recent = self.recent.setdefault(chat_id, deque())
+        while recent and now - recent[0] >= 60:
+            recent.popleft()
+        
+        reason = None
+        if job and self.queued.get(chat_id, 0) >= limits['max_queued']:
+            reason = f"⏳ Bạn đã có {limits['max_queued']} yêu cầu đang chờ. Vui lòng đợi."
+        elif len(recent) >= limits['messages_per_minute']:
+            wait = int(60 - (now - recent[0])) + 1
+            reason = f"⏳ Quá {limits['messages_per_minute']} tin nhắn/phút. Thử lại sau {wait}s."
+        elif usage['tokens'] >= limits['tokens_per_day']:
+            reason = f"❌ Đã hết hạn mức {limits['tokens_per_day']} tokens hôm nay."
+        
+        self.dirty = True
+        if reason:
+            usage['rejected'] += 1
+            return reason
+        
+        recent.append(now)
+        usage['messages'] += 1
+        if job:
+            self.queued[chat_id] = self.queued.get(chat_id, 0) + 1
+        return None
+    
+    def release(self, chat_id: int) -> None:
+        """Mark an admitted job as finished"""
+        count = self.queued.get(chat_id, 0) - 1
+        if count > 0:
+            self.queued[chat_id] = count
+        else:
+            self.queued.pop(chat_id, None)
+    
+    def record_tokens(self, chat_id: int, tokens: int) -> None:
+        """Add generated tokens (Ollama eval_count) to today's usage"""
+        self._rollover()
+        self._usage(chat_id)['tokens'] += tokens
+        self.dirty = True
+    
+    def flush(self) -> None:
+        """Persist usage increments since the last flush"""
+        with self.flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            day = self.day
+            zero = {'messages': 0, 'tokens': 0, 'rejected': 0}
+            snapshot = {chat_id: dict(usage) for chat_id, usage in dict(self.usage).items()}
+            deltas = {}
+            for chat_id, usage in snapshot.items():
+                base = self.flushed.get(chat_id, zero)
+                delta = {key: usage[key] - base[key] for key in zero}
+                if any(delta.values()):
+                    deltas[chat_id] = delta
+            if not deltas:
+                return
+            if db.save_usage(day, deltas):
+                if day == self.day:  # Not reset by a rollover meanwhile
+                    self.flushed.update(snapshot)
+            else:
+                self.dirty = True  # Retry the same increments next time
+    
+    async def run_flush_loop(self) -> None:
+        """Background task: persist counters every QUOTA_FLUSH_INTERVAL"""
+        try:
+            while True:
+                await asyncio.sleep(config.QUOTA_FLUSH_INTERVAL)
+                await asyncio.to_thread(self.flush)
+        finally:
+            self.flush()
+    
+    def get_stats(self, all_chats: bool = False) -> Dict[int, Dict[str, Any]]:
+        """
+        Get today's usage with effective limits per chat
+        all_chats: when sharded, also include chats owned by other workers
+        as of their last flush (their queue length is unknown: None)
+        """
+        self._rollover()
+        chat_ids = set(self.usage) | set(self.queued)
+        stats = {
+            chat_id: {
+                **self.usage.get(chat_id, {'messages': 0, 'tokens': 0, 'rejected': 0}),
+                'queued': self.queued.get(chat_id, 0),
+                'limits': self.get_limits(chat_id),
+            }
+            for chat_id in chat_ids
+        }
+        if all_chats and shard_router.ring is not None:
+            overrides = db.get_quotas()
+            for chat_id, usage in db.get_usage(self.day).items():
+                if not shard_router.owns(chat_id):
+                    stats[chat_id] = {**usage, 'queued': None, 'limits': overrides.get(chat_id, self.defaults)}
+        return dict(sorted(stats.items()))
+
+quota_manager = LazyInstance(QuotaManager)
+
+##############################################################################
+# Message Coalescing
+##############################################################################
+
+class MessageCoalescer:
+    """
+    Merge rapid consecutive messages from the same chat into one user turn
+    The first message opens a batch and waits for COALESCE_WINDOW of silence;
+    later messages arriving during that window, or while the batch waits for
+    the inference lock, are appended and answered by a single inference.
+    """
+    
+    def __init__(self, window: float, max_wait: float, max_length: int):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_length = max_length
+        self.batches: Dict[int, List[Dict[str, Any]]] = {}  # chat_id -> open batches, oldest first
+        self.merged_count = 0
+    
+    def open(self, chat_id: int, message: str) -> Dict[str, Any]:
+        """
+        Start a new batch for chat_id (the caller answers it)
+        Queued behind batches that are still open, e.g. a full one
+        """
+        batch = {
+            'messages': [message],
+            'length': len(message),
+            'started': time.monotonic(),
+            'last': time.monotonic(),
+        }
+        self.batches.setdefault(chat_id, []).append(batch)
+        return batch
+    
+    def can_merge(self, chat_id: int, message: str) -> bool:
+        """Check if message fits into the newest open batch of chat_id"""
+        batches = self.batches.get(chat_id)
+        return bool(batches) and batches[-1]['length'] + len(message) + 1 <= self.max_length
+    
+    def merge(self, chat_id: int, message: str) -> None:
+        """Append message to the newest open batch of chat_id"""
+        batch = self.batches[chat_id][-1]
+        batch['messages'].append(message)
+        batch['length'] += len(message) + 1
+        batch['last'] = time.monotonic()
+        self.merged_count += 1
+    
+    async def wait(self, batch: Dict[str, Any]) -> None:
+        """Debounce: wait until the batch has been quiet for the window"""
+        while True:
+            now = time.monotonic()
+            deadline = min(batch['last'] + self.window, batch['started'] + self.max_wait)
+            if now >= deadline:
+                return
+            await asyncio.sleep(deadline - now)
+    
+    def discard(self, chat_id: int, reason: str) -> int:
+        """Cancel every open batch of chat_id (their handlers will not infer)"""
+        batches = self.batches.pop(chat_id, [])
+        for batch in batches:
+            batch['cancelled'] = reason
+        return len(batches)
+    
+    def close(self, chat_id: int, batch: Dict[str, Any]) -> str:
+        """Stop accepting messages and return the merged user turn"""
+        batches = [b for b in self.batches.get(chat_id, []) if b is not batch]
+        if batches:
+            self.batches[chat_id] = batches
+        else:
+            self.batches.pop(chat_id, None)
+        return '\n'.join(batch['messages'])
+
+coalescer = LazyInstance(lambda: MessageCoalescer(
+    config.COALESCE_WINDOW,
+    config.COALESCE_MAX_WAIT,
+    config.MAX_MESSAGE_LENGTH
+))
+
+##############################################################################
+# Inference Jobs & Cancellation
+##############################################################################
+
+class InferenceCancelled(Exception):
+    """Raised when an inference job is cancelled before completion"""
+    
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class JobRegistry:
+    """
+    Track running inference jobs so they can be cancelled
+    Cancelling a job cancels its asyncio task, which closes the HTTP
+    stream to Ollama and stops generation server-side
+    """
+    
+    def __init__(self):
+        self.jobs: Dict[int, Dict[str, Any]] = {}  # job_id -> job
+        self.next_id = 1
+        self.cancelled_count = 0
+    
+    def register(self, chat_id: int, route: str, message: str, task: asyncio.Task) -> Dict[str, Any]:
+        """Register a running inference task"""
+        job = {
+            'id': self.next_id,
+            'chat_id': chat_id,
+            'route': route,
+            'message': message,
+            'task': task,
+            'started': time.monotonic(),
+            'reason': None,
+        }
+        self.jobs[job['id']] = job
+        self.next_id += 1
+        return job
+    
+    def finish(self, job: Dict[str, Any]) -> None:
+        """Remove job from registry"""
+        self.jobs.pop(job['id'], None)
+    
+    def cancel(self, job_id: int, reason: str) -> bool:
+        """Cancel one job by ID"""
+        job = self.jobs.get(job_id)
+        if job is None or job['task'].done():
+            return False
+        job['reason'] = reason
+        job['task'].cancel()
+        self.cancelled_count += 1
+        logger.info(f"Cancelled job #{self.label(job_id)} (chat {job['chat_id']}): {reason}")
+        return True
+    
+    def cancel_chat(self, chat_id: int, reason: str, route: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Cancel all running jobs of a chat (optionally only one route)"""
+        cancelled = []
+        for job in list(self.jobs.values()):
+            if job['chat_id'] == chat_id and (route is None or job['route'] == route):
+                if self.cancel(job['id'], reason):
+                    cancelled.append(job)
+        return cancelled
+    
+    def cancel_all(self, reason: str) -> int:
+        """Cancel every running job"""
+        return sum(self.cancel(job_id, reason) for job_id in list(self.jobs))
+    
+    @staticmethod
+    def label(job_id: int) -> str:
+        """Job ID shown to the admin, prefixed with the worker number when sharded"""
+        if config.WORKER_INDEX is None:
+            return str(job_id)
+        return f"{config.WORKER_INDEX + 1}.{job_id}"
+    
+    @staticmethod
+    def parse_label(label: str) -> Tuple[Optional[int], int]:
+        """
+        Parse a job label ("#12" or "2.12")
+        Returns: (worker index or None if unprefixed, job ID)
+        Raises: ValueError on malformed labels or unknown workers
+        """
+        worker, _, job_id = label.lstrip('#').rpartition('.')
+        if not worker:
+            return None, int(job_id)
+        index = int(worker) - 1
+        if not 0 <= index < config.BOT_WORKERS:
+            raise ValueError(f"Unknown worker {worker}")
+        return index, int(job_id)
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """Get running jobs (oldest first)"""
+        now = time.monotonic()
+        return [
+            {
+                'id': job['id'],
+                'label': self.label(job['id']),
+                'chat_id': job['chat_id'],
+                'route': job['route'],
+                'elapsed': now - job['started'],
+            }
+            for job in sorted(self.jobs.values(), key=lambda j: j['id'])
+        ]
+
+job_registry = LazyInstance(JobRegistry)
+
+##############################################################################
+# System Monitoring
+##############################################################################
+
+class SystemMonitor:
+    """Monitor system resources"""
+    
+    @staticmethod
+    def get_memory_info() -> Dict[str, Any]:
+        """Get memory usage information"""
+        import psutil
+        vm = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        
+        return {
+            'total_gb': vm.total / (1024**3),
+            'used_gb': vm.used / (1024**3),
+            'available_gb': vm.available / (1024**3),
+            'percent': vm.percent,
+            'swap_total_gb': swap.total / (1024**3),
+            'swap_used_gb': swap.used / (1024**3),
+            'swap_percent': swap.percent,
+        }
+    
+    @staticmethod
+    def get_cpu_info() -> Dict[str, Any]:
+        """Get CPU usage information"""
+        import psutil
+        return {
+            'cores': psutil.cpu_count(),
+            'percent': psutil.cpu_percent(interval=0.5),
+            'per_core': psutil.cpu_percent(interval=0.5, percpu=True),
+            'load_avg': os.getloadavg(),
+        }
+    
+    @staticmethod
+    def get_full_status() -> str:
+        """Get full system status report"""
+        mem = SystemMonitor.get_memory_info()
+        cpu = SystemMonitor.get_cpu_info()
+        queue_status = queue_manager.get_queue_status()
+        ready = ai_agent.get_readiness()
+        governor = memory_governor
+        sample = governor.last_sample
+        events = '\n'.join(
+            f"  {e['time']} {e['action']} {e['detail']}".rstrip() for e in list(governor.events)[-3:]
+        ) or '  -'
+
+        warmup = f"{ready['warmup_seconds']:.1f}s" if ready['warmup_seconds'] is not None else '-'
+        first_reply = f"{ready['first_reply_seconds']:.1f}s" if ready['first_reply_seconds'] is not None else '-'
+        shard = ''
+        if config.WORKER_INDEX is not None:
+            shard = f"\n**Worker:** {config.WORKER_INDEX + 1}/{config.BOT_WORKERS} ({config.OLLAMA_URL})"
         
         status = f"""
 📊 **SYSTEM STATUS REPORT**
@@ -356,13 +1560,603 @@ class SystemMonitor:
 **AI Queue:**
 ├─ Processing: {'Yes' if queue_status['processing'] else 'No'}
 ├─ Waiting Queue: {queue_status['queue_length']}
-└─ Waiting Users: {queue_status['waiting_users']}
+├─ Waiting Users: {queue_status['waiting_users']}
+├─ Running Jobs: {len(job_registry.jobs)}
+├─ Cancelled Jobs: {job_registry.cancelled_count}
+└─ Merged Messages: {coalescer.merged_count}
 
-**Model:** {config.OLLAMA_MODEL}
-**Threads:** {config.OLLAMA_THREADS}
+**Memory Governor:**
+├─ Level: {governor.LEVEL_NAMES[governor.level]}
+├─ Bot RSS: {sample.get('bot_rss_mb', 0):.0f}MB
+├─ Ollama RSS: {sample.get('ollama_rss_mb', 0):.0f}MB
+├─ Context: num_ctx={governor.num_ctx}, history={governor.history_limit}
+├─ Admissions: {'Paused' if governor.admissions_paused else 'Open'}
+└─ Recent events:
+{events}
+
+**Readiness:**
+├─ Model: {ready['state']}{f" ({ready['error']})" if ready['error'] else ''}
+├─ Warm-up: {warmup}
+├─ First reply: {first_reply}
+└─ Uptime: {ready['uptime_seconds']:.0f}s
+
+**Model:** {config.OLLAMA_MODEL}{shard}
+**Threads:** {ai_agent.tuning['num_thread']} (ctx {ai_agent.tuning['num_ctx']}, batch {ai_agent.tuning['num_batch']}, {ai_agent.tuning['source']})
         """
         return status.strip()
 
+##############################################################################
+# Memory Governor
+##############################################################################
+
+class MemoryGovernor:
+    """
+    Adaptive memory governor
+    Watches bot RSS, Ollama RSS and system available memory, and steps
+    through pressure levels instead of forcing periodic gc.collect():
+      0 - normal
+      1 - shrink num_ctx and history budget
+      2 - also drop in-process caches
+      3 - also pause admissions and unload idle Ollama models
+    """
+    
+    LEVEL_NAMES = ['normal', 'reduced', 'drop-caches', 'critical']
+    RECOVERY_MARGIN = 1.2  # Need 20% headroom above a boundary to step down
+    
+    def __init__(self):
+        self.level = 0
+        self.num_ctx = config.OLLAMA_NUM_CTX
+        self.history_limit = config.HISTORY_LIMIT
+        self.admissions_paused = False
+        self.last_sample: Dict[str, float] = {}
+        self.events: deque = deque(maxlen=50)
+        self.last_used: Dict[str, float] = {}  # model -> monotonic time of its last request
+    
+    def _event(self, action: str, detail: str = '') -> None:
+        """Log a governor action as an event"""
+        self.events.append({
+            'time': datetime.now().strftime('%H:%M:%S'),
+            'level': self.level,
+            'action': action,
+            'detail': detail,
+        })
+        logger.warning(f"[governor] level={self.level} {action} {detail}".rstrip())
+    
+    def tune_gc(self) -> None:
+        """
+        Tune GC once after startup: move startup objects to the permanent
+        generation and raise thresholds so collections are rare and cheap
+        """
+        gc.collect()
+        gc.freeze()
+        gc.set_threshold(*config.GC_THRESHOLDS)
+        self._event('gc-tuned', f"frozen={gc.get_freeze_count()} thresholds={config.GC_THRESHOLDS}")
+    
+    @staticmethod
+    def sample() -> Dict[str, float]:
+        """Measure bot RSS, Ollama RSS and system available memory (MB)"""
+        import psutil
+        
+        ollama_rss = 0
+        for proc in psutil.process_iter(['name', 'memory_info']):
+            name = proc.info.get('name') or ''
+            if name.startswith('ollama') and proc.info.get('memory_info'):
+                ollama_rss += proc.info['memory_info'].rss
+        
+        return {
+            'bot_rss_mb': psutil.Process().memory_info().rss / (1024**2),
+            'ollama_rss_mb': ollama_rss / (1024**2),
+            'available_mb': psutil.virtual_memory().available / (1024**2),
+        }
+    
+    @staticmethod
+    def _level_for(available_mb: float, bot_rss_mb: float) -> int:
+        threshold = config.MEMORY_THRESHOLD_MB
+        if available_mb < threshold / 2:
+            level = 3
+        elif available_mb < threshold:
+            level = 2
+        elif available_mb < threshold * 2:
+            level = 1
+        else:
+            level = 0
+        if bot_rss_mb > config.BOT_RSS_LIMIT_MB:
+            level = max(level, 2)
+        return level
+    
+    async def check(self) -> None:
+        """Sample memory and move to the matching level"""
+        sample = await asyncio.to_thread(self.sample)
+        self.last_sample = sample
+        
+        target = self._level_for(sample['available_mb'], sample['bot_rss_mb'])
+        if target < self.level:
+            # Step down only with headroom (hysteresis)
+            relaxed = self._level_for(
+                sample['available_mb'] / self.RECOVERY_MARGIN,
+                sample['bot_rss_mb'] * self.RECOVERY_MARGIN
+            )
+            target = max(target, min(relaxed, self.level))
+        
+        if target != self.level:
+            await self._apply(target, sample)
+        elif self.level >= 3:
+            await self.unload_idle_models()  # Models busy earlier may be idle by now
+    
+    async def _apply(self, target: int, sample: Dict[str, float]) -> None:
+        """Run the actions for moving from the current level to target"""
+        previous = self.level
+        self.level = target
+        self._event(
+            'level-change',
+            f"{self.LEVEL_NAMES[previous]} -> {self.LEVEL_NAMES[target]} "
+            f"(available={sample['available_mb']:.0f}MB bot={sample['bot_rss_mb']:.0f}MB "
+            f"ollama={sample['ollama_rss_mb']:.0f}MB)"
+        )
+        
+        num_ctx = config.REDUCED_NUM_CTX if target >= 1 else config.OLLAMA_NUM_CTX
+        history_limit = config.REDUCED_HISTORY_LIMIT if target >= 1 else config.HISTORY_LIMIT
+        if (num_ctx, history_limit) != (self.num_ctx, self.history_limit):
+            self.num_ctx, self.history_limit = num_ctx, history_limit
+            self._event('context-budget', f"num_ctx={num_ctx} history={history_limit}")
+        
+        if target >= 2 and previous < 2:
+            self.drop_caches()
+        
+        paused = target >= 3
+        if paused != self.admissions_paused:
+            self.admissions_paused = paused
+            self._event('admissions-paused' if paused else 'admissions-resumed')
+        
+        if target >= 3 and previous < 3:
+            await self.unload_idle_models()
+    
+    def drop_caches(self) -> None:
+        """Drop in-process caches and return freed heap to the OS"""
+        dropped = len(tracer.recent)
+        tracer.recent.clear()
+        chunks = document_store.drop_cache()
+        collected = gc.collect()
+        try:
+            import ctypes
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except Exception:
+            pass
+        self._event('caches-dropped', f"traces={dropped} doc_chunks={chunks} gc_collected={collected}")
+    
+    @staticmethod
+    def _tagged(name: str) -> str:
+        return name if ':' in name else f'{name}:latest'
+    
+    def touch(self, model: str) -> None:
+        """Record that a request to model just finished"""
+        self.last_used[self._tagged(model)] = time.monotonic()
+    
+    def is_idle(self, model: str) -> bool:
+        """No running job may use model and it was unused for MODEL_IDLE_SECONDS"""
+        name = self._tagged(model)
+        if job_registry.jobs and name in {self._tagged(config.OLLAMA_MODEL),
+                                          self._tagged(config.OLLAMA_EMBED_MODEL)}:
+            return False
+        last_used = self.last_used.get(name)
+        return last_used is None or time.monotonic() - last_used >= config.MODEL_IDLE_SECONDS
+    
+    async def unload_idle_models(self) -> None:
+        """
+        Ask Ollama to unload the models this worker has not used recently
+        The chat model is included once idle: a cold start on the next
+        request is cheaper than running out of memory. Ollama defers the
+        unload while another worker is still generating on the same backend.
+        """
+        import httpx
+        
+        try:
+            async with httpx.AsyncClient(base_url=config.OLLAMA_URL, timeout=10) as client:
+                response = await client.get('/api/ps')
+                response.raise_for_status()
+                for model in response.json().get('models', []):
+                    name = model.get('name') or model.get('model')
+                    if not self.is_idle(name):
+                        continue
+                    await client.post('/api/generate', json={'model': name, 'keep_alive': 0})
+                    self._event('model-unloaded', name)
+        except Exception as e:
+            logger.error(f"[governor] Error unloading models: {str(e)}")
+    
+    async def run_loop(self) -> None:
+        """Background task: check memory every GOVERNOR_INTERVAL"""
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"[governor] Error checking memory: {str(e)}")
+            await asyncio.sleep(config.GOVERNOR_INTERVAL)
+
+memory_governor = LazyInstance(MemoryGovernor)
+
+##############################################################################
+# Host Auto-tuning
+##############################################################################
+
+class Autotuner:
+    """
+    Calibrate Ollama inference options for a backend and model
+    Sweeps num_thread, then num_batch, then num_ctx (coordinate descent),
+    measuring prompt-eval and eval tokens/sec from Ollama's counters.
+    The best profile is stored per host, backend URL and model in
+    TUNING_PROFILES_PATH (each shard worker may use a different backend).
+    """
+    
+    # ~300-token prompt, long enough for a stable prompt-eval rate
+    BENCH_PROMPT = (
+        "Hãy đọc đoạn văn sau và tóm tắt ngắn gọn bằng tiếng Việt.\n\n"
+        + "Trí tuệ nhân tạo chạy cục bộ giúp bảo vệ dữ liệu cá nhân, giảm độ trễ mạng "
+          "và cho phép tùy chỉnh mô hình theo phần cứng sẵn có của người dùng. " * 8
+    )
+    
+    # Typical request shape used to score a profile (prompt, generated tokens)
+    TYPICAL_PROMPT_TOKENS = 1000
+    TYPICAL_EVAL_TOKENS = 200
+    
+    def __init__(self, model: str, url: str):
+        self.model = model
+        self.url = url
+        self.results: List[Dict[str, Any]] = []
+    
+    @staticmethod
+    def host_key(model: str, url: str) -> str:
+        import socket
+        return f"{socket.gethostname()}|{url.rstrip('/')}|{model}"
+    
+    @staticmethod
+    def load_profile(model: str, url: str) -> Optional[Dict[str, Any]]:
+        """Load tuned profile for this host, backend and model (None if not tuned)"""
+        import socket
+        from urllib.parse import urlparse
+        try:
+            with open(config.TUNING_PROFILES_PATH, 'r', encoding='utf-8') as f:
+                profiles = json.load(f)
+            profile = profiles.get(Autotuner.host_key(model, url))
+            if profile is None and urlparse(url).hostname in ('localhost', '127.0.0.1'):
+                # Profiles saved before the backend URL was part of the key
+                profile = profiles.get(f"{socket.gethostname()}|{model}")
+            return profile
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error loading tuning profile: {str(e)}")
+            return None
+    
+    @staticmethod
+    def save_profile(model: str, url: str, profile: Dict[str, Any]) -> None:
+        """Persist tuned profile for this host, backend and model"""
+        path = Path(config.TUNING_PROFILES_PATH)
+        profiles = {}
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                profiles = json.load(f)
+        profiles[Autotuner.host_key(model, url)] = profile
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(profiles, f, indent=2)
+        tmp_path.replace(path)
+    
+    @staticmethod
+    def thread_candidates() -> List[int]:
+        """num_thread values around the physical core count"""
+        import psutil
+        physical = psutil.cpu_count(logical=False) or os.cpu_count() or 4
+        logical = psutil.cpu_count() or physical
+        candidates = {max(1, physical // 2), max(1, physical - 2), physical, logical}
+        return sorted(candidates)
+    
+    def _score(self, result: Dict[str, Any]) -> float:
+        """Estimated seconds for a typical request (lower is better)"""
+        return (self.TYPICAL_PROMPT_TOKENS / max(result['prompt_tps'], 1e-6)
+                + self.TYPICAL_EVAL_TOKENS / max(result['eval_tps'], 1e-6))
+    
+    async def _bench(self, client, num_thread: int, num_ctx: int, num_batch: int) -> Dict[str, Any]:
+        """Run one benchmark generation and measure tokens/sec"""
+        response = await client.generate(
+            model=self.model,
+            prompt=self.BENCH_PROMPT,
+            options={
+                'num_thread': num_thread,
+                'num_ctx': num_ctx,
+                'num_batch': num_batch,
+                'num_predict': config.AUTOTUNE_PREDICT,
+                'temperature': 0,
+                'seed': 42,
+            }
+        )
+        result = {
+            'num_thread': num_thread,
+            'num_ctx': num_ctx,
+            'num_batch': num_batch,
+            'prompt_tps': response.get('prompt_eval_count', 0) / max(response.get('prompt_eval_duration', 0), 1) * 1e9,
+            'eval_tps': response.get('eval_count', 0) / max(response.get('eval_duration', 0), 1) * 1e9,
+        }
+        result['score'] = self._score(result)
+        self.results.append(result)
+        logger.info(
+            f"[autotune] thread={num_thread} ctx={num_ctx} batch={num_batch}: "
+            f"prompt {result['prompt_tps']:.1f} tok/s, eval {result['eval_tps']:.1f} tok/s"
+        )
+        return result
+    
+    async def run(self, progress: Optional[Callable[[str], Any]] = None) -> Dict[str, Any]:
+        """
+        Run the calibration sweep and persist the best profile
+        
+        Args:
+            progress: Optional async callback receiving status lines
+        """
+        import ollama
+        client = ollama.AsyncClient(host=self.url)
+        
+        async def report(line: str):
+            if progress:
+                await progress(line)
+        
+        # 1. num_thread at default ctx/batch
+        best = None
+        for num_thread in self.thread_candidates():
+            result = await self._bench(client, num_thread, config.OLLAMA_NUM_CTX, config.OLLAMA_NUM_BATCH)
+            if best is None or result['score'] < best['score']:
+                best = result
+        await report(f"num_thread={best['num_thread']} ({best['eval_tps']:.1f} tok/s)")
+        
+        # 2. num_batch with best threads
+        for num_batch in config.AUTOTUNE_BATCH_CANDIDATES:
+            if num_batch != best['num_batch']:
+                result = await self._bench(client, best['num_thread'], best['num_ctx'], num_batch)
+                if result['score'] < best['score']:
+                    best = result
+        await report(f"num_batch={best['num_batch']} ({best['prompt_tps']:.1f} tok/s prompt)")
+        
+        # 3. num_ctx: keep the largest context within tolerance of the best score
+        by_ctx = {best['num_ctx']: best}
+        for num_ctx in config.AUTOTUNE_CTX_CANDIDATES:
+            if num_ctx not in by_ctx and num_ctx <= config.OLLAMA_NUM_CTX:
+                by_ctx[num_ctx] = await self._bench(client, best['num_thread'], num_ctx, best['num_batch'])
+        fastest = min(r['score'] for r in by_ctx.values())
+        best = max(
+            (r for r in by_ctx.values() if r['score'] <= fastest * (1 + config.AUTOTUNE_TOLERANCE)),
+            key=lambda r: r['num_ctx']
+        )
+        await report(f"num_ctx={best['num_ctx']}")
+        
+        profile = {
+            'num_thread': best['num_thread'],
+            'num_ctx': best['num_ctx'],
+            'num_batch': best['num_batch'],
+            'prompt_tps': round(best['prompt_tps'], 2),
+            'eval_tps': round(best['eval_tps'], 2),
+            'runs': len(self.results),
+            'tuned_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save_profile(self.model, self.url, profile)
+        logger.info(f"[autotune] Saved profile for {self.host_key(self.model, self.url)}: {profile}")
+        return profile
+
+##############################################################################
+# Document Retrieval
+##############################################################################
+
+class DocumentStore:
+    """
+    Per-chat retrieval index over uploaded documents
+    Uploads are chunked and embedded with Ollama; vectors are normalised
+    float32 arrays stored as SQLite blobs and cached per chat in memory,
+    so follow-up questions only pull the top-k relevant chunks into the
+    prompt instead of re-uploading and re-reading the whole file.
+    Indexing runs as a background job (cancellable, outside the inference
+    slot); loading and scoring run in a worker thread.
+    """
+    
+    def __init__(self):
+        self.model = config.OLLAMA_EMBED_MODEL
+        self.client = None  # httpx.AsyncClient, created on first call
+        self.batch_endpoint = True  # /api/embed (Ollama >= 0.3), else /api/embeddings
+        self.cache: Dict[int, List[Tuple[str, str, array]]] = {}  # chat_id -> chunks
+        self.index_lock = asyncio.Lock()  # One upload embedded at a time
+        self.index_tasks: set = set()  # Strong references to background jobs
+    
+    @staticmethod
+    def chunk_text(text: str) -> List[str]:
+        """Split text into overlapping chunks, preferring paragraph/sentence breaks"""
+        size, overlap = config.DOC_CHUNK_CHARS, config.DOC_CHUNK_OVERLAP
+        chunks = []
+        start = 0
+        while start < len(text):
+            end = min(start + size, len(text))
+            if end < len(text):
+                window = text[start:end]
+                cut = max(window.rfind('\n\n'), window.rfind('. '), window.rfind('\n'))
+                if cut > size // 2:
+                    end = start + cut + 1
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= len(text):
+                break
+            start = max(end - overlap, start + 1)
+        return chunks
+    
+    @staticmethod
+    def _normalize(vector: List[float]) -> array:
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return array('f', (x / norm for x in vector))
+    
+    @staticmethod
+    def _ollama_error(response) -> Optional[str]:
+        """Error message of an Ollama JSON error response, if any"""
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        return body.get('error') if isinstance(body, dict) else None
+    
+    def _raise_for_status(self, response) -> None:
+        """Raise with Ollama's own message (e.g. model not found, pull it)"""
+        if response.is_error:
+            error = self._ollama_error(response)
+            if error:
+                raise RuntimeError(f"Ollama: {error}")
+            response.raise_for_status()
+    
+    async def embed(self, texts: List[str]) -> List[array]:
+        """Embed texts in one request with the Ollama embedding model (unit length)"""
+        import httpx
+        if self.client is None:
+            self.client = httpx.AsyncClient(base_url=config.OLLAMA_URL, timeout=120)
+        
+        try:
+            with tracer.span('ollama.embed', model=self.model, count=len(texts)):
+                if self.batch_endpoint:
+                    response = await self.client.post('/api/embed', json={'model': self.model, 'input': texts})
+                    # A missing model is also a 404, but with a JSON error
+                    if response.status_code != 404 or self._ollama_error(response):
+                        self._raise_for_status(response)
+                        return [self._normalize(vector) for vector in response.json()['embeddings']]
+                    self.batch_endpoint = False
+                    logger.info("Ollama has no /api/embed, embedding one text per request")
+            
+                vectors = []
+                for text in texts:
+                    response = await self.client.post('/api/embeddings', json={'model': self.model, 'prompt': text})
+                    self._raise_for_status(response)
+                    vectors.append(self._normalize(response.json()['embedding']))
+                return vectors
+        finally:
+            memory_governor.touch(self.model)
+    
+    async def add_document(self, chat_id: int, file_name: str, text: str) -> int:
+        """Chunk, embed and persist a document, returns number of chunks"""
+        texts = self.chunk_text(text)
+        chunks = []
+        for start in range(0, len(texts), config.DOC_EMBED_BATCH):
+            batch = texts[start:start + config.DOC_EMBED_BATCH]
+            vectors = await self.embed(batch)
+            chunks.extend((chunk, vector.tobytes()) for chunk, vector in zip(batch, vectors))
+        
+        await asyncio.to_thread(db.add_document, chat_id, file_name, self.model, chunks)
+        self.cache.pop(chat_id, None)
+        logger.info(f"Indexed {file_name} for chat {chat_id}: {len(chunks)} chunks")
+        return len(chunks)
+    
+    def start_indexing(self, chat_id: int, file_name: str, text: str,
+                       notify: Callable[[str], Any]) -> asyncio.Task:
+        """
+        Index a document in a background job
+        The job is registered in JobRegistry (route 'index') so /cancel,
+        /clear and /remove stop it, and is capped by DOC_INDEX_MAX_SECONDS.
+        notify is an async callback receiving the outcome message.
+        """
+        async def run():
+            async with self.index_lock:
+                return await asyncio.wait_for(
+                    self.add_document(chat_id, file_name, text), timeout=config.DOC_INDEX_MAX_SECONDS
+                )
+        
+        async def supervise():
+            task = asyncio.create_task(run())
+            job = job_registry.register(chat_id, 'index', file_name, task)
+            try:
+                chunk_count = await task
+                message = f"📚 Đã lưu {chunk_count} đoạn của {file_name} để trả lời câu hỏi tiếp theo."
+            except asyncio.CancelledError:
+                if not job['reason']:
+                    raise
+                message = f"🛑 Đã hủy lưu tài liệu {file_name} ({job['reason']})"
+            except asyncio.TimeoutError:
+                logger.warning(f"Indexing {file_name} exceeded {config.DOC_INDEX_MAX_SECONDS}s, stopped")
+                message = f"⚠️ Lưu tài liệu {file_name} quá {config.DOC_INDEX_MAX_SECONDS}s, đã dừng."
+            except Exception as e:
+                logger.error(f"Error indexing document: {str(e)}")
+                message = f"❌ Không thể lưu tài liệu {file_name}: {str(e)}"
+            finally:
+                job_registry.finish(job)
+            try:
+                await notify(message)
+            except Exception as e:
+                logger.error(f"Error sending indexing result: {str(e)}")
+        
+        task = asyncio.create_task(supervise())
+        self.index_tasks.add(task)
+        task.add_done_callback(self.index_tasks.discard)
+        return task
+    
+    def _load(self, chat_id: int) -> List[Tuple[str, str, array]]:
+        if chat_id not in self.cache:
+            chunks = []
+            for file_name, content, blob in db.get_document_chunks(chat_id, self.model):
+                vector = array('f')
+                vector.frombytes(blob)
+                chunks.append((file_name, content, vector))
+            self.cache[chat_id] = chunks
+        return self.cache[chat_id]
+    
+    @staticmethod
+    def _score(chunks: List[Tuple[str, str, array]], query_vector: array,
+               top_k: int) -> List[Tuple[float, str, str]]:
+        scored = [
+            (sum(map(operator.mul, query_vector, vector)), file_name, content)
+            for file_name, content, vector in chunks
+            if len(vector) == len(query_vector)
+        ]
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [item for item in scored[:top_k] if item[0] >= config.DOC_MIN_SCORE]
+    
+    async def search(self, chat_id: int, query: str, top_k: int) -> List[Tuple[float, str, str]]:
+        """
+        Top-k chunks of the chat's documents by cosine similarity
+        Returns: [(score, file_name, content)], best first
+        """
+        chunks = await asyncio.to_thread(self._load, chat_id)
+        if not chunks:
+            return []
+        
+        query_vector = (await self.embed([query]))[0]
+        with tracer.span('docs.search', chunks=len(chunks)):
+            return await asyncio.to_thread(self._score, chunks, query_vector, top_k)
+    
+    async def build_context(self, chat_id: int, query: str, budget_chars: int) -> Optional[str]:
+        """Relevant chunks formatted for the prompt, within budget_chars"""
+        try:
+            hits = await self.search(chat_id, query, config.DOC_TOP_K)
+        except Exception as e:
+            logger.error(f"Document retrieval failed: {str(e)}")
+            return None
+        
+        parts = []
+        used = 0
+        for score, file_name, content in hits:
+            if used + len(content) > budget_chars:
+                break
+            parts.append(f"[{file_name}]\n{content}")
+            used += len(content)
+        
+        if not parts:
+            return None
+        return "Trích đoạn tài liệu người dùng đã gửi (dùng nếu liên quan):\n\n" + '\n\n---\n\n'.join(parts)
+    
+    async def has_documents(self, chat_id: int) -> bool:
+        return bool(await asyncio.to_thread(self._load, chat_id))
+    
+    def delete(self, chat_id: int) -> int:
+        """Delete all documents of a chat"""
+        self.cache.pop(chat_id, None)
+        return db.delete_documents(chat_id)
+    
+    def drop_cache(self) -> int:
+        """Drop cached vectors (reloaded from SQLite on demand)"""
+        dropped = sum(len(chunks) for chunks in self.cache.values())
+        self.cache.clear()
+        return dropped
+
+document_store = LazyInstance(DocumentStore)
+
 ##############################################################################
 # Ollama AI Integration
 ##############################################################################
@@ -377,13 +2171,100 @@ class AIAgent:
         self.model = config.OLLAMA_MODEL
         self.url = config.OLLAMA_URL
         self.response_count = 0
+        self.client = None  # ollama.AsyncClient, created on first call
+        
+        # Host-tuned inference options (falls back to Config defaults)
+        self.tuning = self.load_tuning()
+        
+        # Readiness state: 'cold' -> 'loading' -> 'ready' | 'error'
+        self.model_state = 'cold'
+        self.model_error: Optional[str] = None
+        self.warmup_seconds: Optional[float] = None
+        self.first_reply_seconds: Optional[float] = None
+    
+    def load_tuning(self) -> Dict[str, Any]:
+        """Load the auto-tuned profile for this agent's backend and model"""
+        tuning = {
+            'num_thread': config.OLLAMA_THREADS,
+            'num_ctx': config.OLLAMA_NUM_CTX,
+            'num_batch': config.OLLAMA_NUM_BATCH,
+            'source': 'default',
+        }
+        profile = Autotuner.load_profile(self.model, self.url)
+        if profile:
+            tuning.update({key: profile[key] for key in ('num_thread', 'num_ctx', 'num_batch')})
+            tuning['source'] = f"autotune {profile.get('tuned_at', '')}".strip()
+            logger.info(f"Loaded tuning profile: {tuning}")
+        return tuning
+    
+    def _options(self, **overrides) -> Dict[str, Any]:
+        """Inference options: tuned profile capped by the memory governor"""
+        options = {
+            'num_thread': self.tuning['num_thread'],
+            'num_ctx': min(self.tuning['num_ctx'], memory_governor.num_ctx),
+            'num_batch': self.tuning['num_batch'],
+        }
+        options.update(overrides)
+        return options
+    
+    async def warm_up(self) -> None:
+        """
+        Preload model in background with a tiny generation
+        Runs after polling has started so the bot is reachable immediately
+        """
+        self.model_state = 'loading'
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(self._warm_up)
+            self.warmup_seconds = time.monotonic() - started
+            self.model_state = 'ready'
+            logger.info(f"Model {self.model} warmed up in {self.warmup_seconds:.1f}s")
+        except Exception as e:
+            self.model_state = 'error'
+            self.model_error = str(e)
+            logger.error(f"Model warm-up failed: {str(e)}")
+    
+    def _warm_up(self) -> None:
+        """Check Ollama connectivity and load model weights on this agent's backend"""
+        import ollama
+        
+        client = ollama.Client(host=self.url)
+        models = client.list()
+        model_entries = models.get('models', []) if isinstance(models, dict) else []
+        model_names = [m.get('name') or m.get('model') or 'unknown' for m in model_entries]
+        logger.info(f"Available models: {model_names}")
+        
+        # 1-token generation forces the model into memory
+        client.generate(
+            model=self.model,
+            prompt='Hi',
+            options=self._options(num_predict=1),
+            keep_alive=config.WARMUP_KEEP_ALIVE
+        )
+    
+    def record_reply(self) -> None:
+        """Record time-to-first-reply since process start (once)"""
+        if self.first_reply_seconds is None:
+            self.first_reply_seconds = time.monotonic() - PROCESS_START
+            logger.info(f"Time to first reply: {self.first_reply_seconds:.1f}s")
+    
+    def get_readiness(self) -> Dict[str, Any]:
+        """Get model readiness information"""
+        return {
+            'state': self.model_state,
+            'error': self.model_error,
+            'warmup_seconds': self.warmup_seconds,
+            'first_reply_seconds': self.first_reply_seconds,
+            'uptime_seconds': time.monotonic() - PROCESS_START,
+        }
     
     async def generate_response(
         self,
         chat_id: int,
         username: str,
         user_message: str,
-        system_prompt: Optional[str] = None
+        system_prompt: Optional[str] = None,
+        route: str = 'chat'
     ) -> str:
         """
         Generate AI response with memory optimization
@@ -393,21 +2274,28 @@ class AIAgent:
             username: Telegram username
             user_message: User's message
             system_prompt: Optional custom system prompt
+            route: Inference route ('chat' or 'file'), selects ROUTE_LIMITS
         
         Returns:
             AI response text
+        
+        Raises:
+            InferenceCancelled: job was cancelled (/cancel, /clear, supersession)
         """
         
-        try:
+        # Registered before retrieval so /clear or a superseding message can
+        # cancel the job while its context is still being built
+        async def run() -> Tuple[str, int, bool]:
             # Get conversation history (limited for memory optimization)
-            history = db.get_history(chat_id, limit=config.HISTORY_LIMIT)
+            history = db.get_history(chat_id, limit=memory_governor.history_limit)
             
             # Build context with memory efficiency
             context_messages = []
             
             # Add system prompt
-            if not system_prompt:
-                system_prompt = f"""You are a helpful AI assistant. You MUST respond ONLY in Vietnamese language.
+            prompt = system_prompt
+            if not prompt:
+                prompt = f"""You are a helpful AI assistant. You MUST respond ONLY in Vietnamese language.
 User: {username}
 
 CRITICAL RULES:
@@ -418,7 +2306,7 @@ CRITICAL RULES:
             
             context_messages.append({
                 'role': 'system',
-                'content': system_prompt
+                'content': prompt
             })
             
             # Add Vietnamese language enforcement example
@@ -435,6 +2323,18 @@ CRITICAL RULES:
             for msg in history:
                 context_messages.append(msg)
             
+            # Add relevant chunks of previously uploaded documents
+            if route == 'chat' and await document_store.has_documents(chat_id):
+                budget_chars = int(
+                    self._options()['num_ctx'] * config.DOC_CTX_FRACTION * config.CHARS_PER_TOKEN
+                )
+                document_context = await document_store.build_context(chat_id, user_message, budget_chars)
+                if document_context:
+                    context_messages.append({
+                        'role': 'system',
+                        'content': document_context
+                    })
+            
             # Add current message
             context_messages.append({
                 'role': 'user',
@@ -443,87 +2343,455 @@ CRITICAL RULES:
             
             # Call Ollama with optimized parameters
             logger.info(f"[{username}] Generating response... (context: {len(history)} messages)")
-            
-            response = await asyncio.to_thread(
-                self._call_ollama,
-                context_messages
-            )
+            return await self._call_ollama(context_messages, route)
+        
+        try:
+            task = asyncio.create_task(run())
+            job = job_registry.register(chat_id, route, user_message, task)
+            try:
+                response, eval_count, timed_out = await task
+            except asyncio.CancelledError:
+                if job['reason']:
+                    raise InferenceCancelled(job['reason'])
+                raise
+            finally:
+                job_registry.finish(job)
             
             # Store in database
             db.add_message(chat_id, username, 'user', user_message)
-            db.add_message(chat_id, username, 'assistant', response)
+            db.add_message(chat_id, username, 'assistant', response, tokens=eval_count)
+            quota_manager.record_tokens(chat_id, eval_count)
             
-            # Garbage collection every N responses (memory optimization)
             self.response_count += 1
-            if self.response_count % config.GC_INTERVAL == 0:
-                gc.collect()
-                logger.debug("Garbage collection triggered")
+            
+            # The notice is for the user only, not part of the stored history
+            if timed_out:
+                response += f"\n\n⚠️ (Đã dừng: vượt quá {config.ROUTE_LIMITS[route]['max_seconds']}s)"
             
             return response
             
+        except InferenceCancelled:
+            raise
         except Exception as e:
             logger.error(f"Error generating response: {str(e)}")
             return f"❌ Lỗi: {str(e)}"
     
-    def _call_ollama(self, messages: List[Dict]) -> str:
-        """Call Ollama API"""
-        try:
-            response = ollama.chat(
-                model=self.model,
-                messages=messages,
-                stream=False,
-                options={
-                    'num_thread': config.OLLAMA_THREADS,
-                    'num_ctx': 4096,
-                    'repeat_penalty': 1.2,
-                    'temperature': 0.3,  # Giảm để tăng tính nhất quán
-                    'top_p': 0.8,
-                    'top_k': 30,
-                }
-            )
+    def _get_client(self):
+        """Get (lazily create) the async Ollama client"""
+        if self.client is None:
+            import ollama
+            self.client = ollama.AsyncClient(host=self.url)
+        return self.client
+    
+    async def _call_ollama(self, messages: List[Dict], route: str = 'chat') -> Tuple[str, int, bool]:
+        """
+        Call Ollama API (streaming, cancellable)
+        Cancelling the calling task closes the HTTP stream, which makes
+        Ollama abort the generation. Output is capped by the route's
+        num_predict and max_seconds; on timeout the partial text is kept.
+        
+        Returns:
+            (response text, generated token count from eval_count, timed out)
+        """
+        limits = config.ROUTE_LIMITS[route]
+        parts: List[str] = []
+        stats: Dict[str, int] = {}
+        timed_out = False
+        
+        try:
+            with tracer.span('ollama.chat', model=self.model, route=route) as attrs:
+                stream = await self._get_client().chat(
+                    model=self.model,
+                    messages=messages,
+                    stream=True,
+                    options=self._options(
+                        num_predict=limits['num_predict'],
+                        repeat_penalty=1.2,
+                        temperature=0.3,  # Giảm để tăng tính nhất quán
+                        top_p=0.8,
+                        top_k=30,
+                    )
+                )
+                
+                async def consume():
+                    chunks = stream.__aiter__()
+                    # Time to first chunk = model load + prompt eval
+                    with tracer.span('ollama.prompt_eval'):
+                        chunk = await chunks.__anext__()
+                    with tracer.span('ollama.generate'):
+                        while True:
+                            parts.append(chunk.get('message', {}).get('content', ''))
+                            if chunk.get('done'):
+                                for key in ('eval_count', 'prompt_eval_count', 'load_duration',
+                                            'prompt_eval_duration', 'eval_duration'):
+                                    stats[key] = int(chunk.get(key) or 0)
+                            try:
+                                chunk = await chunks.__anext__()
+                            except StopAsyncIteration:
+                                break
+                
+                try:
+                    await asyncio.wait_for(consume(), timeout=limits['max_seconds'])
+                except asyncio.TimeoutError:
+                    logger.warning(f"Inference exceeded {limits['max_seconds']}s ({route}), stopped")
+                    timed_out = attrs['timed_out'] = True
+                except StopAsyncIteration:
+                    pass
+                finally:
+                    await stream.aclose()
+                
+                attrs.update(stats)
             
-            return response.get('message', {}).get('content', 'No response')
+            content = ''.join(parts) or 'No response'
+            # Streamed chunks are ~1 token each when the final stats are missing
+            return content, stats.get('eval_count', len(parts)), timed_out
         
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"Ollama API error: {str(e)}")
             raise
+        finally:
+            memory_governor.touch(self.model)
+    
+    async def process_file(self, file_path: str, file_name: str, chat_id: int) -> str:
+        """Process uploaded text file"""
+        try:
+            if not file_name.endswith('.txt'):
+                return "❌ Chỉ hỗ trợ file .txt"
+            
+            # Read file (with size limit for memory)
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                content = f.read(config.MAX_MESSAGE_LENGTH)
+            
+            if len(content) == 0:
+                return "❌ File trống hoặc không thể đọc"
+            
+            # Generate summary/analysis
+            summary_prompt = f"""Phân tích và tóm tắt nội dung file sau ({file_name}):
+
+{content[:config.MAX_MESSAGE_LENGTH]}
+
+Hãy:
+1. Tóm tắt quá trình chính
+2. Những điểm chính
+3. Đề xuất hành động (nếu có)"""
+            
+            response = await self.generate_response(
+                chat_id,
+                'File Analysis',
+                summary_prompt,
+                route='file'
+            )
+            
+            return response
+        
+        except InferenceCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"Error processing file: {str(e)}")
+            return f"❌ Lỗi xử lý file: {str(e)}"
+
+ai_agent = LazyInstance(AIAgent)
+
+##############################################################################
+# Sharded Deployment
+##############################################################################
+
+class ShardRing:
+    """
+    Consistent hash ring mapping chat_id -> worker index
+    Each worker owns VNODES points, so resizing from N to N+1 workers moves
+    only ~1/(N+1) of the chats (and their in-process state) to a new owner
+    """
+    
+    VNODES = 160
+    
+    def __init__(self, workers: int, vnodes: int = VNODES):
+        points = sorted(
+            (self._hash(f'worker-{worker}#{vnode}'), worker)
+            for worker in range(workers)
+            for vnode in range(vnodes)
+        )
+        self.workers = workers
+        self.keys = [key for key, _ in points]
+        self.owners = [worker for _, worker in points]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+    
+    def lookup(self, chat_id: int) -> int:
+        """Worker index that owns this chat"""
+        index = bisect.bisect(self.keys, self._hash(str(chat_id))) % len(self.keys)
+        return self.owners[index]
+
+class UpdateBroker:
+    """
+    SQLite-backed queue between the front process and shard workers
+    The front appends raw updates tagged with their shard. Each worker
+    claims its own rows in arrival order and deletes them only after they
+    were handled, so a crashed worker's claims are redelivered when it
+    restarts (at-least-once). Works on SQLite < 3.35 (no RETURNING).
+    """
+    
+    MAX_ATTEMPTS = 3  # Deliveries before an update is dropped as poison
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS updates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    shard INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    claimed_at REAL,
+                    attempts INTEGER DEFAULT 0
+                )
+            ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(updates)')}
+            if 'claimed_at' not in columns:
+                conn.execute('ALTER TABLE updates ADD COLUMN claimed_at REAL')
+                conn.execute('ALTER TABLE updates ADD COLUMN attempts INTEGER DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_updates_shard ON updates(shard, id)')
+    
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+    
+    def put(self, shard: int, chat_id: int, payload: str) -> None:
+        """Append one update for a shard"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT INTO updates (shard, chat_id, payload, created) VALUES (?, ?, ?, ?)',
+                (shard, chat_id, payload, time.time())
+            )
+        finally:
+            conn.close()
+    
+    def claim(self, shard: int, limit: int) -> List[Tuple[int, str]]:
+        """
+        Mark up to `limit` oldest unclaimed updates of a shard as claimed
+        Returns: [(update row id, payload)] in arrival order
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT id, payload, attempts FROM updates
+                WHERE shard = ? AND claimed_at IS NULL
+                ORDER BY id LIMIT ?
+            ''', (shard, limit)).fetchall()
+            poison = [row_id for row_id, _, attempts in rows if attempts >= self.MAX_ATTEMPTS]
+            claimed = [(row_id, payload) for row_id, payload, attempts in rows if attempts < self.MAX_ATTEMPTS]
+            if poison:
+                conn.execute(f"DELETE FROM updates WHERE id IN ({','.join('?' * len(poison))})", poison)
+                logger.error(f"Dropped {len(poison)} updates of shard {shard} after {self.MAX_ATTEMPTS} attempts")
+            if claimed:
+                ids = [row_id for row_id, _ in claimed]
+                conn.execute(
+                    f"UPDATE updates SET claimed_at = ?, attempts = attempts + 1 "
+                    f"WHERE id IN ({','.join('?' * len(ids))})",
+                    [time.time(), *ids]
+                )
+            conn.execute('COMMIT')
+            return claimed
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def ack(self, row_id: int) -> None:
+        """Delete an update once it was handled"""
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM updates WHERE id = ?', (row_id,))
+        finally:
+            conn.close()
+    
+    def release(self, shard: int) -> int:
+        """Return a shard's claimed updates to the queue (previous worker died)"""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                'UPDATE updates SET claimed_at = NULL WHERE shard = ? AND claimed_at IS NOT NULL', (shard,)
+            ).rowcount
+        finally:
+            conn.close()
+    
+    def rebalance(self, ring: ShardRing) -> int:
+        """Re-route pending updates after the worker count changed (and release claims)"""
+        moved = 0
+        with sqlite3.connect(self.db_path, timeout=10) as conn:
+            conn.execute('UPDATE updates SET claimed_at = NULL')
+            for row_id, shard, chat_id in conn.execute('SELECT id, shard, chat_id FROM updates').fetchall():
+                owner = ring.lookup(chat_id)
+                if owner != shard:
+                    conn.execute('UPDATE updates SET shard = ? WHERE id = ?', (owner, row_id))
+                    moved += 1
+        return moved
+    
+    def pending(self) -> Dict[int, int]:
+        """Pending update count per shard"""
+        with sqlite3.connect(self.db_path, timeout=10) as conn:
+            return dict(conn.execute('SELECT shard, COUNT(*) FROM updates GROUP BY shard').fetchall())
+
+class ShardRouter:
+    """
+    Run control actions (cancel, quota reload, job and trace listing) on
+    the process that holds the state. Single-process mode and owned chats
+    run locally; other workers get a control message through the broker
+    and report results to the admin chat themselves.
+    """
+    
+    def __init__(self):
+        self.ring = None
+        self.broker = None
+        self.bot = None  # Set by worker_main, used to report control results
+        if config.WORKER_INDEX is not None:
+            self.ring = ShardRing(config.BOT_WORKERS)
+            self.broker = UpdateBroker(config.BROKER_PATH)
+    
+    def owns(self, chat_id: int) -> bool:
+        """Whether this process owns the chat's in-memory state"""
+        return self.ring is None or self.ring.lookup(chat_id) == config.WORKER_INDEX
+    
+    def tag(self) -> str:
+        """' (worker i/N)' suffix for admin replies in sharded mode"""
+        if self.ring is None:
+            return ''
+        return f" (worker {config.WORKER_INDEX + 1}/{config.BOT_WORKERS})"
+    
+    async def _forward(self, index: int, chat_id: int, action: str, args: Dict[str, Any]) -> None:
+        payload = json.dumps({'control': action, 'chat_id': chat_id, 'args': args})
+        await asyncio.to_thread(self.broker.put, index, chat_id, payload)
+    
+    async def send(self, chat_id: int, action: str, **args) -> Optional[Any]:
+        """
+        Run action for chat_id on its owner
+        Returns: local result, or None if forwarded to another worker
+        """
+        if self.owns(chat_id):
+            return self.apply(chat_id, action, args)
+        await self._forward(self.ring.lookup(chat_id), chat_id, action, args)
+        return None
+    
+    async def send_to_worker(self, index: Optional[int], action: str, **args) -> Optional[Any]:
+        """
+        Run action on worker index (None or own index = this process)
+        Returns: local result, or None if forwarded to another worker
+        """
+        if self.ring is None or index is None or index == config.WORKER_INDEX:
+            return self.apply(0, action, args)
+        await self._forward(index, 0, action, args)
+        return None
+    
+    async def broadcast(self, action: str, **args) -> int:
+        """Send action to every other worker, returns how many were sent to"""
+        if self.ring is None:
+            return 0
+        others = [index for index in range(config.BOT_WORKERS) if index != config.WORKER_INDEX]
+        for index in others:
+            await self._forward(index, 0, action, args)
+        return len(others)
+    
+    @staticmethod
+    def apply(chat_id: int, action: str, args: Dict[str, Any]) -> Any:
+        """Execute a control action locally"""
+        reason = args.get('reason', 'admin')
+        if action == 'cancel_chat':
+            return len(job_registry.cancel_chat(chat_id, reason)) + coalescer.discard(chat_id, reason)
+        if action == 'reload_quota':
+            quota_manager.reload_limits(chat_id)
+            return 1
+        if action == 'cancel_job':
+            return int(job_registry.cancel(args['job_id'], reason))
+        if action == 'cancel_all':
+            return job_registry.cancel_all(reason)
+        if action == 'list_jobs':
+            return job_registry.list_jobs()
+        if action == 'slowest_traces':
+            return tracer.slowest(args['n'])
+        raise ValueError(f"Unknown control action: {action}")
     
-    async def process_file(self, file_path: str, file_name: str, chat_id: int) -> str:
-        """Process uploaded text file"""
-        try:
-            if not file_name.endswith('.txt'):
-                return "❌ Chỉ hỗ trợ file .txt"
-            
-            # Read file (with size limit for memory)
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read(config.MAX_MESSAGE_LENGTH)
-            
-            if len(content) == 0:
-                return "❌ File trống hoặc không thể đọc"
-            
-            # Generate summary/analysis
-            summary_prompt = f"""Phân tích và tóm tắt nội dung file sau ({file_name}):
+    def _report(self, action: str, args: Dict[str, Any], result: Any) -> Optional[str]:
+        """Admin message for a forwarded action's result (None = nothing to say)"""
+        if action == 'cancel_all' and result:
+            return f"✅ Đã hủy {result} yêu cầu{self.tag()}"
+        if action == 'cancel_job':
+            label = job_registry.label(args['job_id'])
+            if result:
+                return f"✅ Đã hủy yêu cầu #{label}"
+            return f"❌ Không tìm thấy yêu cầu đang chạy #{label}"
+        if action == 'list_jobs' and result:
+            return _format_jobs(result)
+        if action == 'slowest_traces' and result:
+            return _format_traces(result)
+        return None
+    
+    async def handle_control(self, data: Dict[str, Any]) -> None:
+        """Apply a control message from the broker and report back to the admin"""
+        result = self.apply(data['chat_id'], data['control'], data['args'])
+        reply_to = data['args'].get('reply_to')
+        message = self._report(data['control'], data['args'], result)
+        if reply_to and message and self.bot is not None:
+            await self.bot.send_message(reply_to, message)
 
-{content}
+shard_router = LazyInstance(ShardRouter)
 
-Hãy:
-1. Tóm tắt quá trình chính
-2. Những điểm chính
-3. Đề xuất hành động (nếu có)"""
-            
-            response = await self.generate_response(
-                chat_id,
-                'File Analysis',
-                summary_prompt
+class WorkerSupervisor:
+    """Spawn shard workers as child processes and restart them if they exit"""
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.restarts: Counter = Counter()
+        self.stopping = False
+    
+    async def _spawn(self, index: int) -> None:
+        self.processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            '--worker', str(index), '--workers', str(self.workers),
+        )
+        logger.info(f"Worker {index + 1}/{self.workers} started (PID: {self.processes[index].pid})")
+    
+    async def _watch(self, index: int) -> None:
+        while not self.stopping:
+            await self._spawn(index)
+            code = await self.processes[index].wait()
+            if self.stopping:
+                break
+            self.restarts[index] += 1
+            logger.error(
+                f"Worker {index + 1}/{self.workers} exited with code {code}, "
+                f"restarting in {config.WORKER_RESTART_DELAY}s"
             )
-            
-            return response
-        
-        except Exception as e:
-            logger.error(f"Error processing file: {str(e)}")
-            return f"❌ Lỗi xử lý file: {str(e)}"
-
-ai_agent = AIAgent()
+            await asyncio.sleep(config.WORKER_RESTART_DELAY)
+    
+    async def run(self) -> None:
+        """Keep all workers alive until cancelled"""
+        try:
+            await asyncio.gather(*(self._watch(index) for index in range(self.workers)))
+        finally:
+            await self.stop()
+    
+    async def stop(self) -> None:
+        """Terminate workers (SIGTERM, then SIGKILL after 10s)"""
+        self.stopping = True
+        running = [p for p in self.processes.values() if p.returncode is None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                process.kill()
 
 ##############################################################################
 # Telegram Bot Handlers
@@ -536,7 +2804,9 @@ def require_admin(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         # Check if admin or whitelisted
-        if chat_id == config.ADMIN_CHAT_ID or db.is_whitelisted(chat_id):
+        with tracer.span('auth.require_admin'):
+            allowed = chat_id == config.ADMIN_CHAT_ID or db.is_whitelisted(chat_id)
+        if allowed:
             return await func(update, context)
         
         await update.message.reply_text(
@@ -545,6 +2815,7 @@ def require_admin(func):
         return
     return wrapper
 
+@traced
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     if update.effective_chat.id != config.ADMIN_CHAT_ID:
@@ -563,12 +2834,20 @@ Có thể trò chuyện, trả lời câu hỏi, và phân tích tài liệu.
 • /start - Hiển thị trợ giúp
 • /sys - Kiểm tra tình trạng hệ thống
 • /clear - Xóa lịch sử chat
+• /search <từ khóa> - Tìm trong lịch sử chat
+• /docs - Tài liệu đã lưu để hỏi tiếp
 • /help - Hướng dẫn chi tiết
 
 **Admin commands:**
 • /add <chat_id> [username] - Thêm người dùng vào whitelist
 • /remove <chat_id> - Xóa người dùng khỏi whitelist
 • /whitelist - Xem danh sách người dùng có quyền
+• /stats - Thống kê sử dụng theo chat
+• /quota <chat\\_id> <tin/phút> <tokens/ngày> <job chờ> - Đặt hạn mức
+• /cancel [job\\_id|chat <chat\\_id>|all] - Xem/hủy yêu cầu AI đang chạy
+• /traces [N] - N yêu cầu chậm nhất (phân rã thời gian)
+• /profile [giây] - Chạy sampling profiler
+• /autotune - Hiệu chỉnh num\\_thread/num\\_ctx cho máy này
 
 **Tính năng:**
 ✓ Trò chuyện AI với tiếng Việt tốt
@@ -582,6 +2861,7 @@ Cứ nhắn cho tôi bất cứ điều gì! 💬
     await update.message.reply_text(welcome_message, parse_mode='Markdown')
     db.update_user_stats(update.effective_chat.id, update.effective_user.username or 'Unknown')
 
+@traced
 @require_admin
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command"""
@@ -593,16 +2873,19 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 **2. Phân tích File:**
    Gửi file .txt, tôi sẽ phân tích nội dung
+   File được lưu lại để bạn hỏi tiếp mà không cần gửi lại (/docs)
 
 **3. Lệnh Hệ Thống:**
    /sys - Xem RAM, CPU, Queue status
    /clear - Xóa lịch sử chat
+   /search <từ khóa> [#trang] [@id] - Tìm trong lịch sử chat
    /stats - Thống kê sử dụng
 
 **4. Queue System:**
    - Chỉ xử lý 1 request AI tại một lúc
    - Nếu đang xử lý, bạn sẽ nhận thông báo "Đang đợi"
    - Thứ tự được giữ lại
+   - Mỗi chat có hạn mức tin nhắn/phút, tokens/ngày và số job chờ
 
 **Lưu Ý:**
 ⚠️  Thời gian phản hồi phụ thuộc vào độ phức tạp câu hỏi
@@ -612,16 +2895,23 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
+@traced
 @require_admin
 async def sys_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /sys command - System status"""
     status = SystemMonitor.get_full_status()
     await update.message.reply_text(f"```\n{status}\n```", parse_mode='Markdown')
 
+@traced
 @require_admin
 async def clear_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /clear command - Clear chat history"""
     chat_id = update.effective_chat.id
+    
+    # Drop pending and running inferences that would use the old history
+    coalescer.discard(chat_id, 'cleared')
+    job_registry.cancel_chat(chat_id, 'cleared')
+    
     try:
         with sqlite3.connect(config.DATABASE_PATH) as conn:
             conn.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
@@ -631,6 +2921,7 @@ async def clear_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Lỗi: {str(e)}")
 
+@traced
 async def add_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /add command - Add user to whitelist (admin only)"""
     # Only admin can add users
@@ -662,6 +2953,7 @@ async def add_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Lỗi: {str(e)}")
 
+@traced
 async def remove_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /remove command - Remove user from whitelist (admin only)"""
     # Only admin can remove users
@@ -680,6 +2972,7 @@ async def remove_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         chat_id = int(context.args[0])
         
         if db.remove_from_whitelist(chat_id):
+            await shard_router.send(chat_id, 'cancel_chat', reason='removed')
             await update.message.reply_text(f"✅ Đã xóa người dùng (ID: {chat_id}) khỏi whitelist")
             logger.info(f"Admin {update.effective_user.username} removed user {chat_id} from whitelist")
         else:
@@ -689,6 +2982,7 @@ async def remove_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e:
         await update.message.reply_text(f"❌ Lỗi: {str(e)}")
 
+@traced
 async def whitelist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /whitelist command - Show all whitelisted users (admin only)"""
     # Only admin can view whitelist
@@ -708,6 +3002,330 @@ async def whitelist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
+@traced
+@require_admin
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /stats command - Usage statistics (admin sees all chats)"""
+    chat_id = update.effective_chat.id
+    # A chat's updates reach its own worker; the admin also sees the others
+    stats = quota_manager.get_stats(all_chats=chat_id == config.ADMIN_CHAT_ID)
+    
+    if chat_id != config.ADMIN_CHAT_ID:
+        stats = {chat_id: stats[chat_id]} if chat_id in stats else {}
+        if not stats:
+            limits = quota_manager.get_limits(chat_id)
+            stats = {chat_id: {'messages': 0, 'tokens': 0, 'rejected': 0, 'queued': 0, 'limits': limits}}
+    
+    if not stats:
+        await update.message.reply_text(f"📊 Chưa có dữ liệu sử dụng hôm nay ({quota_manager.day})")
+        return
+    
+    message = f"📊 THỐNG KÊ SỬ DỤNG ({quota_manager.day})\n\n"
+    for stat_chat_id, s in stats.items():
+        limits = s['limits']
+        queued = '?' if s['queued'] is None else s['queued']
+        message += (
+            f"• ID {stat_chat_id}\n"
+            f"  ├─ Tin nhắn: {s['messages']} (từ chối: {s['rejected']})\n"
+            f"  ├─ Tokens: {s['tokens']} / {limits['tokens_per_day']}\n"
+            f"  ├─ Đang chờ: {queued} / {limits['max_queued']}\n"
+            f"  └─ Giới hạn: {limits['messages_per_minute']} tin/phút\n"
+        )
+    if any(s['queued'] is None for s in stats.values()):
+        message += f"\n(?) Chat của worker khác: số liệu lưu gần nhất (mỗi {config.QUOTA_FLUSH_INTERVAL}s)"
+    
+    await update.message.reply_text(message)
+
+@traced
+async def quota_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /quota command - Set per-chat quota (admin only)"""
+    if update.effective_chat.id != config.ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Chỉ admin có thể đặt hạn mức")
+        return
+    
+    if not context.args or len(context.args) != 4:
+        await update.message.reply_text(
+            "❌ Cách dùng: /quota <chat_id> <tin/phút> <tokens/ngày> <số job chờ>\n"
+            "Ví dụ: /quota 1234567890 6 50000 2"
+        )
+        return
+    
+    try:
+        chat_id, per_minute, per_day, max_queued = (int(arg) for arg in context.args)
+        
+        if quota_manager.set_limits(chat_id, per_minute, per_day, max_queued):
+            # The worker owning the chat enforces it
+            await shard_router.send(chat_id, 'reload_quota')
+            await update.message.reply_text(
+                f"✅ Hạn mức cho ID {chat_id}: {per_minute} tin/phút, "
+                f"{per_day} tokens/ngày, {max_queued} job chờ"
+            )
+            logger.info(f"Admin {update.effective_user.username} set quota for {chat_id}")
+        else:
+            await update.message.reply_text("❌ Lỗi khi đặt hạn mức")
+    except ValueError:
+        await update.message.reply_text("❌ Các tham số phải là số nguyên")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Lỗi: {str(e)}")
+
+def _format_jobs(jobs: List[Dict[str, Any]]) -> str:
+    """/cancel listing of running jobs"""
+    message = f"⚙️ YÊU CẦU ĐANG CHẠY{shard_router.tag()}:\n\n"
+    for job in jobs:
+        message += f"• #{job['label']} - ID {job['chat_id']} ({job['route']}, {job['elapsed']:.0f}s)\n"
+    message += "\n/cancel <job_id> | /cancel chat <chat_id> | /cancel all"
+    return message
+
+def _format_traces(traces: List[Dict[str, Any]]) -> str:
+    """/traces listing of the slowest traces"""
+    message = f"🐢 {len(traces)} TRACE CHẬM NHẤT{shard_router.tag()}:\n\n"
+    for trace in traces:
+        root = trace['spans'][0]
+        message += f"• {trace['name']} - {trace['duration']:.2f}s (chat {root['attributes'].get('chat_id')})\n"
+        message += f"  trace_id: {trace['trace_id']}\n"
+        for name, seconds in trace['breakdown'][:5]:
+            message += f"  ├─ {name}: {seconds:.2f}s\n"
+    return message
+
+@traced
+async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /cancel command - List or cancel running inferences (admin only)"""
+    chat_id = update.effective_chat.id
+    if chat_id != config.ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Chỉ admin có thể hủy yêu cầu")
+        return
+    
+    if not context.args:
+        jobs = job_registry.list_jobs()
+        # Other shard workers answer with their own lists
+        others = await shard_router.broadcast('list_jobs', reply_to=chat_id)
+        message = _format_jobs(jobs) if jobs else f"📝 Không có yêu cầu nào đang chạy{shard_router.tag()}"
+        if others:
+            message += f"\n\n📨 {others} worker khác sẽ gửi danh sách riêng nếu có yêu cầu đang chạy"
+        await update.message.reply_text(message)
+        return
+    
+    try:
+        if context.args[0] == 'all':
+            count = job_registry.cancel_all('admin')
+            others = await shard_router.broadcast('cancel_all', reason='admin', reply_to=chat_id)
+            if others:
+                await update.message.reply_text(
+                    f"✅ Đã hủy {count} yêu cầu{shard_router.tag()}, đã gửi lệnh hủy tới "
+                    f"{others} worker khác (mỗi worker báo lại nếu hủy được yêu cầu)"
+                )
+                return
+        elif context.args[0] == 'chat' and len(context.args) > 1:
+            target = int(context.args[1])
+            count = await shard_router.send(target, 'cancel_chat', reason='admin')
+            if count is None:
+                await update.message.reply_text(f"✅ Đã gửi yêu cầu hủy tới worker phụ trách ID {target}")
+                return
+        else:
+            worker, job_id = job_registry.parse_label(context.args[0])
+            count = await shard_router.send_to_worker(
+                worker, 'cancel_job', job_id=job_id, reason='admin', reply_to=chat_id
+            )
+            if count is None:
+                await update.message.reply_text(f"✅ Đã gửi yêu cầu hủy #{context.args[0].lstrip('#')} tới worker {worker + 1}")
+                return
+        
+        if count:
+            await update.message.reply_text(f"✅ Đã hủy {count} yêu cầu")
+        else:
+            await update.message.reply_text("❌ Không tìm thấy yêu cầu đang chạy")
+    except ValueError:
+        await update.message.reply_text("❌ ID không hợp lệ (dạng 12 hoặc 2.12 cho worker 2)")
+
+@traced
+async def traces_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /traces command - Show slowest recent traces (admin only)"""
+    chat_id = update.effective_chat.id
+    if chat_id != config.ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Chỉ admin có thể xem traces")
+        return
+    
+    try:
+        n = int(context.args[0]) if context.args else 5
+    except ValueError:
+        await update.message.reply_text("❌ Cách dùng: /traces [N]")
+        return
+    n = max(1, min(n, 20))
+    
+    traces = tracer.slowest(n)
+    # Other shard workers answer with their own slowest traces
+    others = await shard_router.broadcast('slowest_traces', n=n, reply_to=chat_id)
+    message = _format_traces(traces) if traces else f"📝 Chưa có trace nào{shard_router.tag()}"
+    if others:
+        message += f"\n\n📨 {others} worker khác sẽ gửi trace của mình"
+    await update.message.reply_text(message)
+
+@traced
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /profile command - Run sampling profiler (admin only)"""
+    if update.effective_chat.id != config.ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Chỉ admin có thể chạy profiler")
+        return
+    
+    try:
+        seconds = float(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("❌ Cách dùng: /profile [giây]")
+        return
+    seconds = max(1.0, min(seconds, config.PROFILE_MAX_SECONDS))
+    
+    if profiler.running:
+        await update.message.reply_text("⏳ Profiler đang chạy")
+        return
+    
+    await update.message.reply_text(f"🔬 Đang lấy mẫu trong {seconds:.0f}s...")
+    try:
+        out_path, top = await profiler.profile(seconds)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Lỗi: {str(e)}")
+        return
+    
+    message = "🔬 TOP FRAMES (% mẫu):\n\n"
+    for frame, percent in top:
+        message += f"• {percent:5.1f}% {frame}\n"
+    message += f"\nFolded stacks: {out_path}"
+    
+    await update.message.reply_text(message)
+
+@traced
+async def autotune_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /autotune command - Calibrate Ollama options for this host (admin only)"""
+    if update.effective_chat.id != config.ADMIN_CHAT_ID:
+        await update.message.reply_text("❌ Chỉ admin có thể chạy autotune")
+        return
+    
+    await update.message.reply_text(
+        "🔧 Bắt đầu hiệu chỉnh (benchmark num_thread, num_batch, num_ctx)...\n"
+        "Các yêu cầu khác sẽ phải đợi đến khi hoàn tất."
+    )
+    
+    async def progress(line: str):
+        await update.message.reply_text(f"🔧 {line}")
+    
+    try:
+        # Hold the inference slot so benchmarks are not disturbed
+        async with queue_manager.slot():
+            profile = await Autotuner(config.OLLAMA_MODEL, ai_agent.url).run(progress)
+        ai_agent.tuning = ai_agent.load_tuning()
+        
+        await update.message.reply_text(
+            f"✅ Profile mới: num_thread={profile['num_thread']}, num_ctx={profile['num_ctx']}, "
+            f"num_batch={profile['num_batch']}\n"
+            f"Prompt: {profile['prompt_tps']} tok/s, Eval: {profile['eval_tps']} tok/s"
+        )
+    except Exception as e:
+        logger.error(f"Autotune failed: {str(e)}")
+        await update.message.reply_text(f"❌ Lỗi autotune: {str(e)}")
+
+def _search_snippet(content: str, terms: List[str], width: int = 160) -> str:
+    """Excerpt of content around the first matching term"""
+    lowered = content.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [pos for pos in positions if pos >= 0]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    excerpt = content[start:start + width].replace('\n', ' ')
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width < len(content) else ''
+    return f"{prefix}{excerpt}{suffix}"
+
+@traced
+@require_admin
+async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /search command - Full-text search in chat history"""
+    chat_id = update.effective_chat.id
+    args = list(context.args or [])
+    
+    # Optional trailing "#N" selects the result page, "@ID" searches
+    # messages older than ID (the next window past SEARCH_CANDIDATES)
+    page = 1
+    before_id = None
+    while args and args[-1][:1] in ('#', '@') and args[-1][1:].isdigit():
+        token = args.pop()
+        if token[0] == '#':
+            page = max(1, int(token[1:]))
+        else:
+            before_id = int(token[1:])
+    query = ' '.join(args)
+    
+    if not query:
+        await update.message.reply_text(
+            "❌ Cách dùng: /search <từ khóa> [#trang] [@id]\n"
+            "Ví dụ: /search giá vàng\n"
+            "Ví dụ: /search giá vàng #2\n"
+            "Ví dụ: /search giá vàng @12345 (tin nhắn cũ hơn id 12345)"
+        )
+        return
+    
+    if not db.fts_enabled:
+        if db.fts_backfill_pending:
+            await update.message.reply_text("⏳ Đang xây dựng chỉ mục tìm kiếm, vui lòng thử lại sau")
+        else:
+            await update.message.reply_text("❌ Tìm kiếm chưa khả dụng (SQLite thiếu FTS5)")
+        return
+    
+    # Admin searches all chats, others only their own
+    scope = None if chat_id == config.ADMIN_CHAT_ID else chat_id
+    page_size = config.SEARCH_PAGE_SIZE
+    try:
+        results, has_more, older_before_id = await asyncio.to_thread(
+            db.search_messages, query, scope, page_size, (page - 1) * page_size, before_id
+        )
+    except Exception as e:
+        logger.error(f"Error searching history: {str(e)}")
+        await update.message.reply_text(f"❌ Lỗi tìm kiếm: {str(e)}")
+        return
+    
+    window = f" @{before_id}" if before_id is not None else ''
+    if not results:
+        await update.message.reply_text(f"🔍 Không tìm thấy kết quả cho \"{query}\" (trang {page}{window})")
+        return
+    
+    terms = query.split()
+    message = f"🔍 KẾT QUẢ CHO \"{query}\" (trang {page}{window}):\n\n"
+    if older_before_id is not None:
+        # Only the newest SEARCH_CANDIDATES matches were ranked
+        message += (
+            f"⚠️ Chỉ xếp hạng {config.SEARCH_CANDIDATES} kết quả mới nhất. "
+            f"Thu hẹp từ khóa hoặc xem kết quả cũ hơn: /search {query} @{older_before_id}\n\n"
+        )
+    for row in results:
+        icon = '👤' if row['role'] == 'user' else '🤖'
+        where = f" [chat {row['chat_id']}]" if scope is None else ''
+        message += f"{icon} {row['timestamp']}{where}\n{_search_snippet(row['content'], terms)}\n\n"
+    if has_more:
+        message += f"➡️ Trang tiếp: /search {query}{window} #{page + 1}"
+    
+    await update.message.reply_text(message[:4096])
+
+@traced
+@require_admin
+async def docs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /docs command - List or clear stored documents of this chat"""
+    chat_id = update.effective_chat.id
+    
+    if context.args and context.args[0] == 'clear':
+        deleted = await asyncio.to_thread(document_store.delete, chat_id)
+        await update.message.reply_text(f"✅ Đã xóa {deleted} tài liệu")
+        return
+    
+    documents = await asyncio.to_thread(db.get_documents, chat_id)
+    if not documents:
+        await update.message.reply_text("📝 Chưa có tài liệu nào. Gửi file .txt để lưu.")
+        return
+    
+    message = "📚 TÀI LIỆU ĐÃ LƯU:\n\n"
+    for document_id, file_name, chunk_count, created_at in documents:
+        message += f"• {file_name} ({chunk_count} đoạn, {created_at})\n"
+    message += "\n/docs clear - Xóa tất cả tài liệu"
+    
+    await update.message.reply_text(message)
+
+@traced
 @require_admin
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle regular messages"""
@@ -722,8 +3340,39 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    # Merge into this chat's pending turn if one is still open
+    if coalescer.can_merge(chat_id, message_text):
+        rejection = quota_manager.acquire(chat_id, job=False)
+        if rejection:
+            await update.message.reply_text(rejection)
+            return
+        coalescer.merge(chat_id, message_text)
+        logger.info(f"[{username}] Message merged into pending turn")
+        return
+    
+    # Memory governor may pause new inferences under critical pressure
+    if memory_governor.admissions_paused:
+        await update.message.reply_text("⚠️ Hệ thống đang thiếu bộ nhớ, vui lòng thử lại sau ít phút")
+        return
+    
+    # Enforce per-chat quotas before queueing
+    rejection = quota_manager.acquire(chat_id)
+    if rejection:
+        await update.message.reply_text(rejection)
+        return
+    
+    batch = coalescer.open(chat_id, message_text)
+    
+    # A new message supersedes the chat's running answer: cancel it and
+    # answer both turns together
+    if config.SUPERSEDE_RUNNING:
+        superseded = job_registry.cancel_chat(chat_id, 'superseded', route='chat')
+        batch['messages'][:0] = [job['message'] for job in superseded]
+    
     # Add to queue and get position
     try:
+        with tracer.span('coalesce.wait'):
+            await coalescer.wait(batch)
         position = await queue_manager.enqueue(chat_id, username, message_text)
         
         if position == 0:
@@ -731,14 +3380,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.chat.send_action(CHAT_ACTION_TYPING)
         else:
             # In queue
-            await update.message.reply_text(
-                f"⏳ Đang đợi... (Vị trí trong hàng: #{position})\n"
-                f"Trước bạn có {position-1} yêu cầu."
-            )
+            with tracer.span('telegram.reply_text'):
+                await update.message.reply_text(
+                    f"⏳ Đang đợi... (Vị trí trong hàng: #{position})\n"
+                    f"Trước bạn có {position-1} yêu cầu."
+                )
 
         # Process the message (serialized by lock)
-        async with queue_manager.lock:
+        async with queue_manager.slot():
             try:
+                message_text = coalescer.close(chat_id, batch)
+                if batch.get('cancelled'):
+                    raise InferenceCancelled(batch['cancelled'])
                 await update.message.chat.send_action(CHAT_ACTION_TYPING)
                 response = await ai_agent.generate_response(chat_id, username, message_text)
             finally:
@@ -751,26 +3404,49 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response = str(response)
 
         # Split response if too long
-        if len(response) > 4096:
-            for i in range(0, len(response), 4096):
-                chunk = response[i:i+4096]
-                await update.message.reply_text(chunk)
-        else:
-            await update.message.reply_text(response)
+        with tracer.span('telegram.reply_text', length=len(response)):
+            if len(response) > 4096:
+                for i in range(0, len(response), 4096):
+                    chunk = response[i:i+4096]
+                    await update.message.reply_text(chunk)
+            else:
+                await update.message.reply_text(response)
+        ai_agent.record_reply()
         
         # Log message
         logger.info(f"[{username}] Processed message (queue pos: #{position})")
         
+    except InferenceCancelled as e:
+        logger.info(f"[{username}] Message cancelled: {e.reason}")
+        if e.reason != 'superseded':
+            await update.message.reply_text(f"🛑 Yêu cầu đã bị hủy ({e.reason})")
+    
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         await update.message.reply_text(f"❌ Lỗi: {str(e)}")
+    
+    finally:
+        coalescer.close(chat_id, batch)
+        quota_manager.release(chat_id)
 
+@traced
 @require_admin
 async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle file uploads"""
     chat_id = update.effective_chat.id
     username = update.effective_user.username or update.effective_user.first_name
     
+    # Memory governor may pause new inferences under critical pressure
+    if memory_governor.admissions_paused:
+        await update.message.reply_text("⚠️ Hệ thống đang thiếu bộ nhớ, vui lòng thử lại sau ít phút")
+        return
+    
+    # Enforce per-chat quotas before queueing
+    rejection = quota_manager.acquire(chat_id)
+    if rejection:
+        await update.message.reply_text(rejection)
+        return
+    
     try:
         file = await update.message.document.get_file()
         file_name = update.message.document.file_name
@@ -779,8 +3455,19 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Download file
         await file.download_to_drive(file_path)
         
+        # Keep the document for follow-up questions: indexed by a background
+        # job, not under the inference slot, so other chats are not held up
+        if file_name.endswith('.txt'):
+            def read_document() -> str:
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    return f.read(config.DOC_MAX_CHARS)
+            
+            text = await asyncio.to_thread(read_document)
+            if text.strip():
+                document_store.start_indexing(chat_id, file_name, text, update.message.reply_text)
+        
         # Process file
-        async with queue_manager.lock:
+        async with queue_manager.slot():
             try:
                 await update.message.chat.send_action(CHAT_ACTION_TYPING)
                 response = await ai_agent.process_file(file_path, file_name, chat_id)
@@ -792,16 +3479,25 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response = await response
         if not isinstance(response, str):
             response = str(response)
-        await update.message.reply_text(response)
+        with tracer.span('telegram.reply_text', length=len(response)):
+            await update.message.reply_text(response)
         
         # Cleanup
         os.remove(file_path)
         
         logger.info(f"[{username}] Processed file: {file_name}")
         
+    except InferenceCancelled as e:
+        logger.info(f"[{username}] File analysis cancelled: {e.reason}")
+        await update.message.reply_text(f"🛑 Phân tích file đã bị hủy ({e.reason})")
+        os.remove(file_path)
+    
     except Exception as e:
         logger.error(f"Error handling document: {str(e)}")
         await update.message.reply_text(f"❌ Lỗi xử lý file: {str(e)}")
+    
+    finally:
+        quota_manager.release(chat_id)
 
 ##############################################################################
 # Application Setup
@@ -809,7 +3505,16 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def setup_application():
     """Setup Telegram application"""
-    application = Application.builder().token(config.TELEGRAM_API_TOKEN).build()
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+    
+    # Concurrent updates let new messages reach the coalescer/queue while
+    # an inference is running (inference itself is serialized by the lock)
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_API_TOKEN)
+        .concurrent_updates(True)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler('start', start_handler))
@@ -819,6 +3524,14 @@ async def setup_application():
     application.add_handler(CommandHandler('add', add_user_handler))
     application.add_handler(CommandHandler('remove', remove_user_handler))
     application.add_handler(CommandHandler('whitelist', whitelist_handler))
+    application.add_handler(CommandHandler('stats', stats_handler))
+    application.add_handler(CommandHandler('quota', quota_handler))
+    application.add_handler(CommandHandler('cancel', cancel_handler))
+    application.add_handler(CommandHandler('traces', traces_handler))
+    application.add_handler(CommandHandler('profile', profile_handler))
+    application.add_handler(CommandHandler('autotune', autotune_handler))
+    application.add_handler(CommandHandler('search', search_handler))
+    application.add_handler(CommandHandler('docs', docs_handler))
     application.add_handler(MessageHandler(filters.Document.TEXT, document_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     
@@ -828,6 +3541,36 @@ async def setup_application():
 # Main Entry Point
 ##############################################################################
 
+def start_background_tasks() -> List[asyncio.Task]:
+    """Start the per-process maintenance loops (caller cancels them)"""
+    tasks = []
+    
+    # Create the database before the first handler needs it; the search
+    # index over existing history is then built off the event loop
+    tasks.append(asyncio.create_task(db.run_search_index_build()))
+    
+    # Startup objects are long-lived: freeze them and relax GC thresholds
+    memory_governor.tune_gc()
+    tasks.append(asyncio.create_task(memory_governor.run_loop()))
+    
+    # Preload model without blocking polling
+    if config.WARMUP_ENABLED:
+        tasks.append(asyncio.create_task(ai_agent.warm_up()))
+    
+    # Persist quota usage counters and traces periodically
+    tasks.append(asyncio.create_task(quota_manager.run_flush_loop()))
+    if config.TRACE_ENABLED:
+        tasks.append(asyncio.create_task(tracer.run_export_loop()))
+    return tasks
+
+def stop_event_on_signals() -> asyncio.Event:
+    """Event set on SIGTERM/SIGINT so shutdown runs the cleanup path"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
 async def main():
     """Main entry point"""
     logger.info("Starting AI Agent Bot...")
@@ -835,38 +3578,324 @@ async def main():
     logger.info(f"Model: {config.OLLAMA_MODEL}")
     logger.info(f"Database: {config.DATABASE_PATH}")
     
-    # Check Ollama connectivity
-    try:
-        models = ollama.list()
-        model_entries = models.get('models', []) if isinstance(models, dict) else []
-        model_names = [m.get('name') or m.get('model') or 'unknown' for m in model_entries]
-        logger.info(f"Available models: {model_names}")
-    except Exception as e:
-        logger.error(f"Cannot connect to Ollama: {str(e)}")
-        sys.exit(1)
-    
     # Setup and start application
     application = await setup_application()
+    background_tasks: List[asyncio.Task] = []
+    # SIGTERM (manage.sh stop, systemd) must reach the finally block so
+    # background tasks run their final flush
+    stop = stop_event_on_signals()
     
     try:
         await application.initialize()
         await application.start()
         await application.updater.start_polling()
+        logger.info(f"Polling started in {time.monotonic() - PROCESS_START:.2f}s")
+        background_tasks.extend(start_background_tasks())
         
         # Keep running
-        while True:
-            await asyncio.sleep(1)
+        await stop.wait()
+        logger.info("Shutting down...")
     
-    except KeyboardInterrupt:
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+
+def make_dispatcher(ring: ShardRing, broker: UpdateBroker):
+    """Front handler: queue every update for the worker owning its chat"""
+    async def dispatch(update, context):
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        await asyncio.to_thread(broker.put, ring.lookup(chat_id), chat_id, json.dumps(update.to_dict()))
+    return dispatch
+
+async def front_main(workers: int):
+    """
+    Front process of the sharded deployment
+    Polls Telegram, routes each update to the worker owning its chat_id
+    and supervises the worker processes
+    """
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler
+    
+    logger.info(f"Starting AI Agent Bot front with {workers} workers...")
+    ring = ShardRing(workers)
+    broker = UpdateBroker(config.BROKER_PATH)
+    moved = broker.rebalance(ring)
+    if moved:
+        logger.info(f"Re-routed {moved} pending updates to new shard owners")
+    
+    application = Application.builder().token(config.TELEGRAM_API_TOKEN).build()
+    application.add_handler(TypeHandler(Update, make_dispatcher(ring, broker)))
+    supervisor = WorkerSupervisor(workers)
+    stop = stop_event_on_signals()
+    supervisor_task = asyncio.create_task(supervisor.run())
+    
+    try:
+        await application.initialize()
+        await application.start()
+        await application.updater.start_polling()
+        logger.info(f"Polling started in {time.monotonic() - PROCESS_START:.2f}s")
+        await stop.wait()
         logger.info("Shutting down...")
     
     finally:
-        await application.stop()
+        supervisor_task.cancel()
+        await asyncio.gather(supervisor_task, return_exceptions=True)
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+
+async def worker_main(index: int, workers: int):
+    """
+    Shard worker: owns the chats the ring maps to `index`
+    Runs the full handler stack with its own inference slot and backend,
+    fed from the broker instead of Telegram polling. An update is removed
+    from the broker only after its handlers finished.
+    """
+    from telegram import Update
+    
+    config.WORKER_INDEX = index
+    config.BOT_WORKERS = workers
+    config.OLLAMA_URL = config.OLLAMA_URLS[index % len(config.OLLAMA_URLS)]
+    logger.info(f"Starting worker {index + 1}/{workers} (backend: {config.OLLAMA_URL})...")
+    
+    broker = UpdateBroker(config.BROKER_PATH)
+    # Claims left by a previous (crashed) incarnation of this shard
+    released = broker.release(index)
+    if released:
+        logger.warning(f"Redelivering {released} updates claimed by the previous worker {index + 1}")
+    
+    application = await setup_application()
+    background_tasks: List[asyncio.Task] = []
+    inflight: set = set()
+    stop = stop_event_on_signals()
+    parent = os.getppid()
+    
+    async def handle(row_id: int, payload: str):
+        try:
+            data = json.loads(payload)
+            if 'control' in data:
+                # Forwarded by the worker that handled an admin command
+                await shard_router.handle_control(data)
+            else:
+                await application.process_update(Update.de_json(data, application.bot))
+        except Exception as e:
+            logger.error(f"Error handling update {row_id}: {str(e)}")
+        finally:
+            inflight.discard(row_id)
+        # Not reached when cancelled: the update is redelivered on restart
+        await asyncio.to_thread(broker.ack, row_id)
+    
+    try:
+        await application.initialize()
+        await application.start()
+        shard_router.bot = application.bot
+        background_tasks.extend(start_background_tasks())
+        
+        # Exit with the front process (a restarted front spawns new workers)
+        while not stop.is_set() and os.getppid() == parent:
+            capacity = min(config.BROKER_BATCH, application.concurrent_updates - len(inflight))
+            claimed = await asyncio.to_thread(broker.claim, index, capacity) if capacity > 0 else []
+            for row_id, payload in claimed:
+                inflight.add(row_id)
+                application.create_task(handle(row_id, payload))
+            if not claimed:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=config.BROKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+    
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if application.running:
+            await application.stop()
         await application.shutdown()
 
+async def autotune_cli():
+    """Run host calibration from the command line (install time)"""
+    async def progress(line: str):
+        print(f"  ✓ {line}")
+    
+    # Every backend a shard worker may use gets its own profile
+    for url in config.OLLAMA_URLS:
+        print(f"Auto-tuning {config.OLLAMA_MODEL} on {url}...")
+        profile = await Autotuner(config.OLLAMA_MODEL, url).run(progress)
+        print(json.dumps(profile, indent=2))
+
+def _install_loadtest_stubs(service_ms: int) -> None:
+    """
+    Load-test worker: replace the Telegram HTTP layer and Ollama inference
+    Everything in between (broker, handlers, quota, queue slot, database)
+    runs unchanged
+    """
+    import telegram
+    
+    async def do_post(self, endpoint: str, data: Dict, *args, **kwargs):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Load', 'username': 'loadtest_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+                'text': data.get('text', ''),
+            }
+        return True
+    
+    async def call_ollama(self, messages: List[Dict], route: str = 'chat'):
+        await asyncio.sleep(service_ms / 1000)  # Held inside the worker's inference slot
+        return 'ok', 1, False
+    
+    def can_merge(self, chat_id: int, message: str) -> bool:
+        return False  # One inference per update, so throughput measures sharding only
+    
+    telegram.Bot._do_post = do_post
+    AIAgent._call_ollama = call_ollama
+    MessageCoalescer.can_merge = can_merge
+
+def loadtest_cli(max_workers: int, updates: int = 400, chats: int = 200, service_ms: int = 20):
+    """
+    Measure front -> broker -> worker throughput for 1..max_workers shards
+    Updates go through the front's dispatch into real worker processes
+    (`--worker I --loadtest-stub MS`), which run the full handler stack
+    with only Telegram HTTP calls and inference stubbed out and message
+    merging disabled: each update costs one serialized inference, so one
+    worker tops out at 1000/MS updates/s
+    """
+    import subprocess
+    import tempfile
+    from telegram import Bot, Update
+    
+    env = {
+        **os.environ,
+        'TELEGRAM_API_TOKEN': '1:loadtest',
+        'ADMIN_CHAT_ID': '1',
+        'QUOTA_MESSAGES_PER_MINUTE': '1000000',
+        'QUOTA_TOKENS_PER_DAY': '1000000000',
+        'QUOTA_MAX_QUEUED': '1000000',
+        'COALESCE_WINDOW': '0',
+        'COALESCE_MAX_WAIT': '0',
+        'SUPERSEDE_RUNNING': '0',
+        'WARMUP_ENABLED': '0',
+        'TRACE_ENABLED': '0',
+    }
+    os.environ.update(env)
+    bot = Bot(env['TELEGRAM_API_TOKEN'])
+    rng = random.Random(42)
+    chat_ids = rng.sample(range(2, 10**9), chats)
+    
+    def make_update(update_id: int, chat_id: int, text: str) -> Update:
+        return Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+                'text': text,
+            },
+        }, bot)
+    
+    async def drain(broker: UpdateBroker, processes: List, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while await asyncio.to_thread(broker.pending):
+            if time.monotonic() > deadline or any(p.poll() is not None for p in processes):
+                return False
+            await asyncio.sleep(config.BROKER_POLL_INTERVAL)
+        return True
+    
+    async def run(workers: int, tmp: str) -> Optional[Tuple[float, Dict[int, int]]]:
+        data_dir = os.path.join(tmp, 'data')
+        os.makedirs(os.path.join(data_dir, 'temp_files'))
+        chat_db = ChatDatabase(os.path.join(data_dir, 'chat_history.db'))
+        for chat_id in chat_ids:
+            chat_db.add_to_whitelist(chat_id, f"load{chat_id}", 1)
+        broker = UpdateBroker(os.path.join(data_dir, 'broker.db'))
+        ring = ShardRing(workers)
+        dispatch = make_dispatcher(ring, broker)
+        
+        processes = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--worker', str(index),
+                 '--workers', str(workers), '--loadtest-stub', str(service_ms)],
+                cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            for index in range(workers)
+        ]
+        try:
+            # One message per shard: returns once every worker is polling
+            for index in range(workers):
+                chat_id = next(c for c in chat_ids if ring.lookup(c) == index)
+                await dispatch(make_update(index, chat_id, 'ping'), None)
+            if not await drain(broker, processes, 60):
+                return None
+            
+            sizes = {index: 0 for index in range(workers)}
+            started = time.perf_counter()
+            for update_id in range(workers, workers + updates):
+                chat_id = rng.choice(chat_ids)
+                sizes[ring.lookup(chat_id)] += 1
+                await dispatch(make_update(update_id, chat_id, 'xin chào'), None)
+            if not await drain(broker, processes, 600):
+                return None
+            return time.perf_counter() - started, sizes
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+    
+    print(f"Load test: {updates} updates, {chats} chats, {service_ms}ms inference stub")
+    print(f"{'workers':>7} {'updates/s':>10} {'speedup':>8} {'efficiency':>10}  shard sizes")
+    baseline = None
+    
+    for workers in range(1, max_workers + 1):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = asyncio.run(run(workers, tmp))
+        if result is None:
+            print(f"{workers:>7} failed: a worker exited or the broker did not drain")
+            continue
+        elapsed, sizes = result
+        rate = updates / elapsed
+        baseline = baseline or rate
+        shard_sizes = ' '.join(str(sizes[index]) for index in range(workers))
+        print(f"{workers:>7} {rate:>10.0f} {rate / baseline:>7.2f}x {rate / baseline / workers:>10.0%}  {shard_sizes}")
+
+def _cli_int(flag: str, default: int) -> int:
+    """Integer value following `flag` in sys.argv"""
+    if flag in sys.argv:
+        position = sys.argv.index(flag) + 1
+        if position < len(sys.argv) and sys.argv[position].isdigit():
+            return int(sys.argv[position])
+    return default
+
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if '--autotune' in sys.argv:
+            asyncio.run(autotune_cli())
+            sys.exit(0)
+        if '--loadtest' in sys.argv:
+            loadtest_cli(_cli_int('--loadtest', 4))
+            sys.exit(0)
+        if '--worker' in sys.argv:
+            if '--loadtest-stub' in sys.argv:
+                _install_loadtest_stubs(_cli_int('--loadtest-stub', 20))
+            asyncio.run(worker_main(_cli_int('--worker', 0), _cli_int('--workers', 1)))
+            sys.exit(0)
+        workers = _cli_int('--workers', config.BOT_WORKERS)
+        if workers > 1:
+            asyncio.run(front_main(workers))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n\nBot stopped by user")
         sys.exit(0)